@@ -0,0 +1,67 @@
+#!/bin/python
+
+# Ouroboros - Copyright (C) 2016 - 2026
+#
+# A simple echo application using a FlowServer
+#
+#    Dimitri Staessens <dimitri@ouroboros.rocks>
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived
+# from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from ouroboros.server import *
+import argparse
+
+
+def client():
+    with flow_alloc("oecho") as f:
+        f.writeline("Hello, PyOuroboros!")
+        print(f.readline())
+
+
+def handle(f):
+    print("New flow.")
+    line = f.readline()
+    print("Message from client is " + line)
+    f.writeline(line)
+
+
+def server():
+    print("Starting the server.")
+    FlowServer(handle, workers=16).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='A simple echo client/server')
+    parser.add_argument('-l', '--listen', help='run as a server', action='store_true')
+    args = parser.parse_args()
+    if args.listen is True:
+        server()
+    else:
+        client()
@@ -0,0 +1,138 @@
+/*
+ * Ouroboros - Copyright (C) 2016 - 2026
+ *
+ * Batched and timed flow I/O helpers
+ *
+ *    Dimitri Staessens <dimitri@ouroboros.rocks>
+ *    Sander Vrijders   <sander@ouroboros.rocks>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public License
+ * version 2.1 as published by the Free Software Foundation.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., http://www.fsf.org/about/contact/.
+ */
+
+#include <ouroboros/dev.h>
+#include <ouroboros/fccntl.h>
+
+/*
+ * Writes n SDUs, SDU i from bufs[i], lens[i] holds its length and is
+ * updated with the result of its write. Returns the number of SDUs
+ * written, or the error if the first write failed.
+ */
+ssize_t flow_write_many(int                  fd,
+                        const void * const * bufs,
+                        size_t *             lens,
+                        size_t               n)
+{
+        size_t  i;
+        ssize_t ret;
+
+        for (i = 0; i < n; ++i) {
+                ret = flow_write(fd, bufs[i], lens[i]);
+                if (ret < 0) {
+                        if (i == 0 && ret != -EAGAIN)
+                                return ret;
+                        break;
+                }
+                lens[i] = (size_t) ret;
+        }
+
+        return (ssize_t) i;
+}
+
+/*
+ * Reads up to n SDUs into consecutive slots of slot bytes in buf,
+ * lens[i] is set to the length of SDU i. Only the first read may
+ * block, after that the rx queue is drained until it is empty or the
+ * read would block. Returns the number of SDUs read, or the error if
+ * the first read failed.
+ */
+ssize_t flow_read_many(int      fd,
+                       void *   buf,
+                       size_t   slot,
+                       size_t * lens,
+                       size_t   n)
+{
+        size_t  i;
+        size_t  qlen;
+        ssize_t ret;
+
+        for (i = 0; i < n; ++i) {
+                if (i > 0 && (fccntl(fd, FLOWGRXQLEN, &qlen) || qlen == 0))
+                        break;
+                ret = flow_read(fd, (char *) buf + i * slot, slot);
+                if (ret < 0) {
+                        if (i == 0 && ret != -EAGAIN)
+                                return ret;
+                        break;
+                }
+                lens[i] = (size_t) ret;
+        }
+
+        return (ssize_t) i;
+}
+
+/*
+ * Write with a timeout for this call only, the send timeout of the
+ * flow is restored afterwards. Not serialised: concurrent calls on
+ * the same fd may see or restore each other's timeout.
+ */
+ssize_t flow_write_timed(int                     fd,
+                         const void *            buf,
+                         size_t                  count,
+                         const struct timespec * timeo)
+{
+        struct timespec   old;
+        struct timespec * prev = &old;
+        ssize_t           ret;
+
+        if (fccntl(fd, FLOWGSNDTIMEO, &old))
+                prev = NULL; /* no timeout set, blocking */
+
+        ret = fccntl(fd, FLOWSSNDTIMEO, timeo);
+        if (ret < 0)
+                return ret;
+
+        ret = flow_write(fd, buf, count);
+
+        fccntl(fd, FLOWSSNDTIMEO, prev);
+
+        return ret;
+}
+
+/*
+ * Read with a timeout for this call only, the receive timeout of the
+ * flow is restored afterwards. Not serialised: concurrent calls on
+ * the same fd may see or restore each other's timeout.
+ */
+ssize_t flow_read_timed(int                     fd,
+                        void *                  buf,
+                        size_t                  count,
+                        const struct timespec * timeo)
+{
+        struct timespec   old;
+        struct timespec * prev = &old;
+        ssize_t           ret;
+
+        if (fccntl(fd, FLOWGRCVTIMEO, &old))
+                prev = NULL; /* no timeout set, blocking */
+
+        ret = fccntl(fd, FLOWSRCVTIMEO, timeo);
+        if (ret < 0)
+                return ret;
+
+        ret = flow_read(fd, buf, count);
+
+        fccntl(fd, FLOWSRCVTIMEO, prev);
+
+        return ret;
+}
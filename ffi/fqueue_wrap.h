@@ -0,0 +1,140 @@
+/*
+ * Ouroboros - Copyright (C) 2016 - 2026
+ *
+ * An fqueue wrapper
+ *
+ *    Dimitri Staessens <dimitri@ouroboros.rocks>
+ *    Sander Vrijders   <sander@ouroboros.rocks>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public License
+ * version 2.1 as published by the Free Software Foundation.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the Free Software
+ * Foundation, Inc., http://www.fsf.org/about/contact/.
+ */
+
+#include <ouroboros/fqueue.h>
+
+#include <errno.h>
+#include <stdbool.h>
+#include <time.h>
+
+/* Longest a wakeable wait blocks before checking its wake flag */
+#define FEVENT_WAKE_SLICE_NS (10 * 1000 * 1000L)
+#define FEVENT_BILLION       (1000 * 1000 * 1000L)
+
+/*
+ * Moves up to n pending events from the queue into the fds and types
+ * arrays. Returns the number of events moved.
+ */
+ssize_t fqueue_drain(fqueue_t * fq,
+                     int *      fds,
+                     int *      types,
+                     size_t     n)
+{
+        size_t i;
+        int    fd;
+
+        for (i = 0; i < n; ++i) {
+                fd = fqueue_next(fq);
+                if (fd < 0)
+                        break;
+                fds[i]   = fd;
+                types[i] = (int) fqueue_type(fq);
+        }
+
+        return (ssize_t) i;
+}
+
+/*
+ * fevent that returns -ECANCELED as soon as *wake is set, which is
+ * cleared again. The wait is split in slices of at most
+ * FEVENT_WAKE_SLICE_NS, so another thread can interrupt it by setting
+ * the flag without any Python code running while the set is idle. The
+ * cost is a wakeup of the waiting thread per slice. fevent is called
+ * at least once, so a zero timeout still polls the set.
+ */
+ssize_t fevent_wakeable(fset_t *                set,
+                        fqueue_t *              fq,
+                        const struct timespec * timeo,
+                        int *                   wake)
+{
+        struct timespec now;
+        struct timespec end;
+        struct timespec slice;
+        long            left;
+        bool            last;
+        ssize_t         ret;
+
+        if (timeo != NULL) {
+                clock_gettime(CLOCK_MONOTONIC, &end);
+                end.tv_sec  += timeo->tv_sec;
+                end.tv_nsec += timeo->tv_nsec;
+                if (end.tv_nsec >= FEVENT_BILLION) {
+                        end.tv_sec  += 1;
+                        end.tv_nsec -= FEVENT_BILLION;
+                }
+        }
+
+        while (true) {
+                if (__atomic_exchange_n(wake, 0, __ATOMIC_ACQ_REL))
+                        return -ECANCELED;
+
+                slice.tv_sec  = 0;
+                slice.tv_nsec = FEVENT_WAKE_SLICE_NS;
+                last          = false;
+
+                if (timeo != NULL) {
+                        clock_gettime(CLOCK_MONOTONIC, &now);
+                        if (end.tv_sec - now.tv_sec > 1)
+                                left = FEVENT_BILLION;
+                        else
+                                left = (end.tv_sec - now.tv_sec)
+                                        * FEVENT_BILLION
+                                        + end.tv_nsec - now.tv_nsec;
+                        if (left <= slice.tv_nsec) {
+                                slice.tv_nsec = left > 0 ? left : 0;
+                                last          = true;
+                        }
+                }
+
+                ret = fevent(set, fq, &slice);
+                if (ret != -ETIMEDOUT || last)
+                        return ret;
+        }
+}
+
+/*
+ * Adds the n flows in fds to the set, stopping at the first failure.
+ * Returns the number of flows added.
+ */
+ssize_t fset_add_many(fset_t *    set,
+                      const int * fds,
+                      size_t      n)
+{
+        size_t i;
+
+        for (i = 0; i < n; ++i)
+                if (fset_add(set, fds[i]) < 0)
+                        break;
+
+        return (ssize_t) i;
+}
+
+/* Removes the n flows in fds from the set. */
+void fset_del_many(fset_t *    set,
+                   const int * fds,
+                   size_t      n)
+{
+        size_t i;
+
+        for (i = 0; i < n; ++i)
+                fset_del(set, fds[i]);
+}
@@ -38,6 +38,11 @@ struct timespec {
 #define OUROBOROS_VERSION_MINOR ...
 #define OUROBOROS_VERSION_PATCH ...
 
+/* OUROBOROS ERRNO.H */
+#define ENOTALLOC ...
+#define EFLOWDOWN ...
+#define EFLOWPEER ...
+
 /* OUROBOROS QOS.H */
 typedef struct qos_spec {
         uint32_t delay;
@@ -97,6 +102,28 @@ int flow_set_frct_flags(int fd, uint16_t flags);
 
 int flow_get_frct_flags(int fd);
 
+/* BATCHED AND TIMED FLOW I/O, VIA WRAPPER */
+ssize_t flow_write_many(int                  fd,
+                        const void * const * bufs,
+                        size_t *             lens,
+                        size_t               n);
+
+ssize_t flow_read_many(int      fd,
+                       void *   buf,
+                       size_t   slot,
+                       size_t * lens,
+                       size_t   n);
+
+ssize_t flow_write_timed(int                     fd,
+                         const void *            buf,
+                         size_t                  count,
+                         const struct timespec * timeo);
+
+ssize_t flow_read_timed(int                     fd,
+                        void *                  buf,
+                        size_t                  count,
+                        const struct timespec * timeo);
+
 /* OUROBOROS FQUEUE.H */
 enum fqtype {
         FLOW_PKT     = ...,
@@ -140,15 +167,37 @@ enum fqtype fqueue_type(fqueue_t * fq);
 ssize_t     fevent(fset_t *                set,
                    fqueue_t *              fq,
                    const struct timespec * timeo);
+
+/* FQUEUE HELPERS, VIA WRAPPER */
+ssize_t     fqueue_drain(fqueue_t * fq,
+                         int *      fds,
+                         int *      types,
+                         size_t     n);
+
+ssize_t     fevent_wakeable(fset_t *                set,
+                            fqueue_t *              fq,
+                            const struct timespec * timeo,
+                            int *                   wake);
+
+ssize_t     fset_add_many(fset_t *    set,
+                          const int * fds,
+                          size_t      n);
+
+void        fset_del_many(fset_t *    set,
+                          const int * fds,
+                          size_t      n);
 """)
 
 ffibuilder.set_source("_ouroboros_dev_cffi",
                       """
 #include "ouroboros/version.h"
+#include "ouroboros/errno.h"
 #include "ouroboros/qos.h"
 #include "ouroboros/dev.h"
 #include "fccntl_wrap.h"
+#include "flow_wrap.h"
 #include "ouroboros/fqueue.h"
+#include "fqueue_wrap.h"
                       """,
                       libraries=['ouroboros-dev'],
                       extra_compile_args=["-I./ffi/"])
@@ -0,0 +1,529 @@
+#
+# Ouroboros - Copyright (C) 2016 - 2026
+#
+# Python API for Ouroboros - asyncio integration
+#
+#    Dimitri Staessens <dimitri@ouroboros.rocks>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# version 2.1 as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., http://www.fsf.org/about/contact/.
+#
+
+import asyncio
+import functools
+import threading
+
+from ouroboros.event import *
+
+# Timeout of a single flow_accept call in a flow server (s)
+AIO_ACCEPT_TIMEO = 1.0
+
+# Backoff bounds when polling for a flow to accept writes (s)
+AIO_WRITE_BACKOFF_MIN = 0.0001
+AIO_WRITE_BACKOFF_MAX = 0.01
+
+# Default maximum SDU size for reads and for stream writes
+AIO_SDU_SIZE = 8192
+
+
+def _wake(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+def _notify(loop: asyncio.AbstractEventLoop,
+            fut: asyncio.Future) -> bool:
+    # wake a waiter from the driver thread, its loop may be gone
+    if fut.done() or loop.is_closed():
+        return False
+
+    try:
+        loop.call_soon_threadsafe(_wake, fut)
+    except RuntimeError:
+        return False    # closed meanwhile
+
+    return True
+
+
+class _FlowEventDriver:
+    """
+    Background thread running fevent over a FlowSet shared by all
+    AsyncFlows in the process, waking up the event loops of the tasks
+    waiting on a flow.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__set = FlowSet()
+        self.__fq = FEventQueue()
+        self.__waiters = dict()
+        self.__ready = set()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="ouroboros-aio",
+                                         daemon=True)
+        self.__thread.start()
+
+    def add(self,
+            flow: Flow) -> None:
+        self.__set.add(flow)
+
+    def remove(self,
+               flow: Flow) -> None:
+        self.__set.remove(flow)
+
+        with self.__lock:
+            self.__ready.discard(flow.fd)
+            waiters = self.__waiters.pop(flow.fd, ())
+
+        for loop, fut in waiters:
+            _notify(loop, fut)
+
+    def __done(self,
+               fd: int,
+               waiter: tuple,
+               fut: asyncio.Future) -> None:
+        # forget a cancelled wait, e.g. by asyncio.wait_for()
+        if not fut.cancelled():
+            return
+
+        with self.__lock:
+            waiters = self.__waiters.get(fd)
+            if waiters is None or waiter not in waiters:
+                return
+            waiters.remove(waiter)
+            if not waiters:
+                del self.__waiters[fd]
+
+    def wait(self,
+             fd: int) -> asyncio.Future:
+        """
+        Get a future that completes on the next event on fd
+
+        An event that arrived while nobody was waiting completes the
+        next future immediately, so no event is lost between a read that
+        would block and the call to wait().
+        """
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        with self.__lock:
+            if fd in self.__ready:
+                self.__ready.discard(fd)
+                fut.set_result(None)
+            else:
+                waiter = (loop, fut)
+                self.__waiters.setdefault(fd, []).append(waiter)
+                fut.add_done_callback(
+                    functools.partial(self.__done, fd, waiter))
+
+        return fut
+
+    def __run(self) -> None:
+        while True:
+            try:
+                self.__set.wait(self.__fq)
+            except FlowEventError:
+                continue
+
+            for fd, _ in self.__fq.drain():
+                with self.__lock:
+                    waiters = self.__waiters.pop(fd, None)
+                    if waiters is None:
+                        self.__ready.add(fd)
+                        continue
+
+                woken = [_notify(loop, fut) for loop, fut in waiters]
+                if not any(woken):
+                    # only stale waiters, keep the event for the next one
+                    with self.__lock:
+                        self.__ready.add(fd)
+
+
+_driver = None
+_driver_lock = threading.Lock()
+
+
+def _get_driver() -> _FlowEventDriver:
+    global _driver
+
+    if _driver is None:
+        with _driver_lock:
+            if _driver is None:
+                _driver = _FlowEventDriver()
+
+    return _driver
+
+
+class AsyncFlow:
+    """
+    A Flow that can be used from asyncio
+
+    The flow is switched to non-blocking mode. Tasks waiting to read are
+    woken up by a single background thread for all flows.
+    """
+
+    def __init__(self,
+                 flow: Flow):
+        """
+        :param flow: An allocated flow
+        """
+
+        if flow.fd < 0:
+            raise FlowNotAllocatedException()
+
+        flow.set_flags(flow.get_flags() | FlowProperties.NonBlocking)
+
+        self.__flow = flow
+        self.__driver = _get_driver()
+        self.__driver.add(flow)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    @property
+    def flow(self) -> Flow:
+        return self.__flow
+
+    async def read(self,
+                   count: int = AIO_SDU_SIZE) -> bytes:
+        """
+        Read bytes from the flow
+
+        :param count:   Maximum number of bytes to read
+        :return:        Bytes read
+        """
+
+        while True:
+            data = self.__flow.try_read(count)
+            if data is not None:
+                return data
+            await self.__driver.wait(self.__flow.fd)
+
+    async def readinto(self,
+                       buf) -> int:
+        """
+        Read bytes from the flow into a writable buffer
+
+        :param buf:     Writable buffer
+        :return:        Number of bytes read
+        """
+
+        while True:
+            n = self.__flow.try_readinto(buf)
+            if n is not None:
+                return n
+            await self.__driver.wait(self.__flow.fd)
+
+    async def write(self,
+                    buf) -> int:
+        """
+        Write bytes to the flow, waiting while it does not accept writes
+
+        :param buf:     Buffer to write from
+        :return:        Number of bytes written
+        """
+
+        delay = AIO_WRITE_BACKOFF_MIN
+        while True:
+            n = self.__flow.try_write(buf)
+            if n is not None:
+                return n
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, AIO_WRITE_BACKOFF_MAX)
+
+    async def drain(self) -> None:
+        """
+        Wait until the transmit queue of the flow is empty
+        """
+
+        delay = AIO_WRITE_BACKOFF_MIN
+        while self.__flow.get_tx_queue_len() > 0:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, AIO_WRITE_BACKOFF_MAX)
+
+    def close(self) -> None:
+        """
+        Deallocate the flow
+        """
+
+        if self.__flow.fd < 0:
+            return
+
+        self.__driver.remove(self.__flow)
+        self.__flow.dealloc()
+
+
+async def async_flow_alloc(dst: str,
+                           qos: QoSSpec = None,
+                           timeo: float = None) -> AsyncFlow:
+    """
+
+    :param dst:    Destination name
+    :param qos:    Requested QoS
+    :param timeo:  Timeout to wait for the allocation
+    :return:       A new AsyncFlow()
+    """
+
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, flow_alloc, dst, qos, timeo)
+    return AsyncFlow(f)
+
+
+async def async_flow_accept(timeo: float = None) -> AsyncFlow:
+    """
+
+    :param timeo:  Timeout to wait for the allocation
+    :return:       A new AsyncFlow()
+    """
+
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, flow_accept, timeo)
+    return AsyncFlow(f)
+
+
+class FlowStreamReader:
+    """
+    Reads a byte stream from an AsyncFlow, like asyncio.StreamReader
+    """
+
+    def __init__(self,
+                 flow: AsyncFlow,
+                 sdu_size: int = AIO_SDU_SIZE):
+        self.__flow = flow
+        self.__sdu_size = sdu_size
+        self.__buf = bytearray()
+        self.__eof = False
+
+    def at_eof(self) -> bool:
+        return self.__eof and not self.__buf
+
+    async def __fill(self) -> bool:
+        if self.__eof:
+            return False
+
+        try:
+            data = await self.__flow.read(self.__sdu_size)
+        except (FlowDownException, FlowNotAllocatedException):
+            self.__eof = True
+            return False
+
+        self.__buf += data
+        return True
+
+    def __take(self, n: int) -> bytes:
+        data = bytes(self.__buf[:n])
+        del self.__buf[:n]
+        return data
+
+    async def read(self,
+                   n: int = -1) -> bytes:
+        if n < 0:
+            while await self.__fill():
+                pass
+            return self.__take(len(self.__buf))
+
+        if not self.__buf:
+            await self.__fill()
+
+        return self.__take(n)
+
+    async def readexactly(self,
+                          n: int) -> bytes:
+        while len(self.__buf) < n:
+            if not await self.__fill():
+                raise asyncio.IncompleteReadError(self.__take(len(self.__buf)),
+                                                  n)
+
+        return self.__take(n)
+
+    async def readuntil(self,
+                        separator: bytes = b"\n") -> bytes:
+        if not separator:
+            raise ValueError("Separator should be at least one byte")
+
+        start = 0
+        while True:
+            i = self.__buf.find(separator, start)
+            if i >= 0:
+                return self.__take(i + len(separator))
+            start = max(0, len(self.__buf) - len(separator) + 1)
+            if not await self.__fill():
+                raise asyncio.IncompleteReadError(self.__take(len(self.__buf)),
+                                                  None)
+
+    async def readline(self) -> bytes:
+        try:
+            return await self.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        line = await self.readline()
+        if not line:
+            raise StopAsyncIteration
+        return line
+
+
+class FlowStreamWriter:
+    """
+    Writes a byte stream to an AsyncFlow, like asyncio.StreamWriter
+    """
+
+    def __init__(self,
+                 flow: AsyncFlow,
+                 sdu_size: int = AIO_SDU_SIZE):
+        self.__flow = flow
+        self.__sdu_size = sdu_size
+        self.__buf = bytearray()
+        self.__closing = None
+
+    @property
+    def flow(self) -> AsyncFlow:
+        return self.__flow
+
+    def get_extra_info(self, name: str, default=None):
+        if name == 'flow':
+            return self.__flow.flow
+        return default
+
+    def write(self,
+              data) -> None:
+        if self.__closing is not None:
+            raise ConnectionResetError("Writer is closing")
+        self.__buf += data
+
+    def writelines(self,
+                   data) -> None:
+        for line in data:
+            self.write(line)
+
+    async def drain(self) -> None:
+        while self.__buf:
+            n = await self.__flow.write(
+                memoryview(self.__buf)[:self.__sdu_size])
+            del self.__buf[:n]
+
+    def is_closing(self) -> bool:
+        return self.__closing is not None
+
+    async def __close(self) -> None:
+        try:
+            await self.drain()
+        finally:
+            self.__flow.close()
+
+    def close(self) -> None:
+        if self.__closing is None:
+            self.__closing = asyncio.ensure_future(self.__close())
+
+    async def wait_closed(self) -> None:
+        if self.__closing is not None:
+            await self.__closing
+
+
+async def open_flow_connection(dst: str,
+                               qos: QoSSpec = None,
+                               timeo: float = None,
+                               sdu_size: int = AIO_SDU_SIZE) -> tuple:
+    """
+    Allocate a flow and return a stream reader and writer for it
+
+    :param dst:      Destination name
+    :param qos:      Requested QoS
+    :param timeo:    Timeout to wait for the allocation
+    :param sdu_size: Maximum SDU size for reads and writes
+    :return:         (FlowStreamReader, FlowStreamWriter)
+    """
+
+    f = await async_flow_alloc(dst, qos, timeo)
+
+    return FlowStreamReader(f, sdu_size), FlowStreamWriter(f, sdu_size)
+
+
+class AsyncFlowServer:
+    """
+    Accepts flows and calls a callback with a stream reader and writer
+    for each of them, see start_flow_server()
+    """
+
+    def __init__(self,
+                 client_connected_cb,
+                 sdu_size: int = AIO_SDU_SIZE):
+        self.__cb = client_connected_cb
+        self.__sdu_size = sdu_size
+        self.__closed = False
+        self.__tasks = set()
+        self.__task = asyncio.ensure_future(self.__serve())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self.close()
+        await self.wait_closed()
+
+    async def __serve(self) -> None:
+        while not self.__closed:
+            try:
+                f = await async_flow_accept(AIO_ACCEPT_TIMEO)
+            except TimeoutError:
+                continue
+
+            if self.__closed:
+                f.close()
+                break
+
+            reader = FlowStreamReader(f, self.__sdu_size)
+            writer = FlowStreamWriter(f, self.__sdu_size)
+            res = self.__cb(reader, writer)
+            if asyncio.iscoroutine(res):
+                task = asyncio.ensure_future(res)
+                self.__tasks.add(task)
+                task.add_done_callback(self.__tasks.discard)
+
+    def is_serving(self) -> bool:
+        return not self.__closed
+
+    def close(self) -> None:
+        """
+        Stop accepting flows, the flows already accepted are not affected
+        """
+
+        self.__closed = True
+
+    async def wait_closed(self) -> None:
+        await self.__task
+
+    async def serve_forever(self) -> None:
+        await self.__task
+
+
+async def start_flow_server(client_connected_cb,
+                            sdu_size: int = AIO_SDU_SIZE) -> AsyncFlowServer:
+    """
+    Start accepting flows, like asyncio.start_server()
+
+    :param client_connected_cb: Called as cb(reader, writer) per flow,
+                                may be a coroutine function
+    :param sdu_size:            Maximum SDU size for reads and writes
+    :return:                    The AsyncFlowServer
+    """
+
+    return AsyncFlowServer(client_connected_cb, sdu_size)
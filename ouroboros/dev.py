@@ -20,6 +20,10 @@
 #
 
 import errno
+import mmap
+import os
+import threading
+import weakref
 from enum import IntFlag
 from math import modf
 from typing import Optional
@@ -56,17 +60,32 @@ MILLION = 1000 * 1000
 BILLION = 1000 * 1000 * 1000
 
 
+# Timespecs are only read by the library, so they are cached per value
+_TIMESPEC_CACHE_SIZE = 64
+_timespec_cache = dict()
+
+
 def _fl_to_timespec(timeo: float):
     if timeo is None:
         return ffi.NULL
-    elif timeo <= 0:
-        return ffi.new("struct timespec *", [0, 0])
+
+    _timeo = _timespec_cache.get(timeo)
+    if _timeo is not None:
+        return _timeo
+
+    if timeo <= 0:
+        _timeo = ffi.new("struct timespec *", [0, 0])
     else:
         frac, whole = modf(timeo)
         _timeo = ffi.new("struct timespec *")
         _timeo.tv_sec = int(whole)
         _timeo.tv_nsec = int(frac * BILLION)
-        return _timeo
+
+    if len(_timespec_cache) >= _TIMESPEC_CACHE_SIZE:
+        _timespec_cache.clear()
+    _timespec_cache[timeo] = _timeo
+
+    return _timeo
 
 
 def _timespec_to_fl(_timeo) -> Optional[float]:
@@ -118,19 +137,19 @@ class FlowAllocatedException(Exception):
     pass
 
 
-class FlowNotAllocatedException(Exception):
+class FlowException(OSError):
     pass
 
 
-class FlowDownException(Exception):
+class FlowNotAllocatedException(FlowException):
     pass
 
 
-class FlowPermissionException(Exception):
+class FlowDownException(FlowException, ConnectionResetError):
     pass
 
 
-class FlowException(Exception):
+class FlowPermissionException(FlowException, PermissionError):
     pass
 
 
@@ -138,19 +157,210 @@ class FlowDeallocWarning(Warning):
     pass
 
 
+# Exception raised for a (positive) errno, FlowException if not listed
+_ERRNO_EXCEPTIONS = {
+    errno.EAGAIN:    BlockingIOError,
+    errno.ETIMEDOUT: TimeoutError,
+    errno.EINVAL:    ValueError,
+    errno.ENOMEM:    MemoryError,
+    errno.EPERM:     FlowPermissionException,
+    lib.ENOTALLOC:   FlowNotAllocatedException,
+    lib.EFLOWDOWN:   FlowDownException,
+    lib.EFLOWPEER:   FlowDownException,
+}
+
+_ERRNO_STRINGS = {
+    lib.ENOTALLOC: "Flow is not allocated",
+    lib.EFLOWDOWN: "Flow is down",
+    lib.EFLOWPEER: "Flow is down (peer timed out)",
+}
+
+
 def _raise(e: int) -> None:
     if e >= 0:
         return
 
-    print("error: " + str(e))
-    if e == -errno.ETIMEDOUT:
-        raise TimeoutError()
-    if e == -errno.EINVAL:
-        raise ValueError()
-    if e == -errno.ENOMEM:
-        raise MemoryError()
+    e = -e
+    exc = _ERRNO_EXCEPTIONS.get(e, FlowException)
+    msg = _ERRNO_STRINGS.get(e) or os.strerror(e)
+    if issubclass(exc, OSError):
+        raise exc(e, msg)
     else:
-        raise FlowException()
+        raise exc(msg)
+
+
+class _open_file:
+    """
+    Context manager yielding a file descriptor for a path, a file
+    descriptor or a file object, only closing what it opened itself
+    """
+
+    def __init__(self, file, flags: int):
+        self.__file = file
+        self.__flags = flags
+        self.__fd = -1
+
+    def __enter__(self) -> int:
+        if isinstance(self.__file, int):
+            return self.__file
+        if hasattr(self.__file, 'fileno'):
+            return self.__file.fileno()
+
+        self.__fd = os.open(self.__file, self.__flags, 0o644)
+        return self.__fd
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+
+
+class BufferPool:
+    """
+    A pool of reusable C buffers, grouped in power-of-two size classes
+
+    Requests larger than max_size are not pooled. Idle buffers are kept
+    up to max_per_class per size class and max_bytes in total, the
+    largest idle buffers are evicted first when that budget is exceeded.
+    """
+
+    def __init__(self,
+                 min_size: int = 256,
+                 max_size: int = 65536,
+                 max_per_class: int = 8,
+                 max_bytes: int = 1024 * 1024):
+        self.__lock = threading.Lock()
+        self.__classes = dict()
+        self.__bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.configure(min_size, max_size, max_per_class, max_bytes)
+
+    def configure(self,
+                  min_size: int = None,
+                  max_size: int = None,
+                  max_per_class: int = None,
+                  max_bytes: int = None) -> None:
+        """
+        Change the pool limits, idle buffers beyond the new limits are evicted
+
+        :param min_size:      Smallest size class in bytes
+        :param max_size:      Largest size class in bytes
+        :param max_per_class: Maximum number of idle buffers per size class
+        :param max_bytes:     Maximum number of idle bytes in the pool
+        """
+
+        with self.__lock:
+            if min_size is not None:
+                self.__min_size = min_size
+            if max_size is not None:
+                self.__max_size = max_size
+            if max_per_class is not None:
+                self.__max_per_class = max_per_class
+            if max_bytes is not None:
+                self.__max_bytes = max_bytes
+
+            if self.__min_size <= 0 or self.__max_size < self.__min_size:
+                raise ValueError("Invalid BufferPool size limits")
+
+            for size in list(self.__classes):
+                free = self.__classes[size]
+                while free and (size > self.__max_size or
+                                len(free) > self.__max_per_class):
+                    self.__drop(free, size)
+            self.__evict(0)
+
+    def __size_class(self,
+                     count: int) -> int:
+        size = self.__min_size
+        while size < count:
+            size <<= 1
+        return size
+
+    def __drop(self, free: list, size: int) -> None:
+        free.pop()
+        self.__bytes -= size
+        self.evictions += 1
+
+    def __evict(self, need: int) -> bool:
+        # make room for <need> bytes, largest size classes first
+        for size in sorted(self.__classes, reverse=True):
+            free = self.__classes[size]
+            while free and self.__bytes + need > self.__max_bytes:
+                self.__drop(free, size)
+        return self.__bytes + need <= self.__max_bytes
+
+    def get(self,
+            count: int):
+        """
+        Get a C buffer of at least <count> bytes
+
+        :param count: Minimum size of the buffer
+        :return:      A cffi char [] buffer
+        """
+
+        if count > self.__max_size:
+            self.misses += 1
+            return ffi.new("char []", count)
+
+        size = self.__size_class(count)
+
+        with self.__lock:
+            free = self.__classes.get(size)
+            if free:
+                self.hits += 1
+                self.__bytes -= size
+                return free.pop()
+            self.misses += 1
+
+        return ffi.new("char []", size)
+
+    def put(self,
+            buf) -> None:
+        """
+        Return a buffer obtained with get() to the pool
+
+        :param buf: The buffer
+        """
+
+        size = len(buf)
+
+        with self.__lock:
+            if size > self.__max_size or size != self.__size_class(size):
+                return
+
+            free = self.__classes.setdefault(size, [])
+            if len(free) >= self.__max_per_class or not self.__evict(size):
+                self.evictions += 1
+                return
+
+            free.append(buf)
+            self.__bytes += size
+
+    def clear(self) -> None:
+        """
+        Release all idle buffers
+        """
+
+        with self.__lock:
+            self.__classes.clear()
+            self.__bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Get the pool counters
+
+        :return: dict with hits, misses, evictions and idle bytes
+        """
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle_bytes': self.__bytes}
+
+
+# Process-wide pool backing Flow.read()
+read_pool = BufferPool()
 
 
 class FlowProperties(IntFlag):
@@ -165,6 +375,34 @@ class FlowProperties(IntFlag):
     NoPartialWrite = 0o200000
 
 
+# Live Flow objects by flow descriptor, filled on alloc/accept/join
+_flows = weakref.WeakValueDictionary()
+
+
+# Called with the flow descriptor of every flow about to be deallocated
+_dealloc_hooks = []
+
+
+def _unregister_flow(fd: int, flow) -> None:
+    if _flows.get(fd) is flow:
+        del _flows[fd]
+
+    if fd >= 0:
+        for hook in _dealloc_hooks:
+            hook(fd)
+
+
+def get_flow(fd: int) -> Optional['Flow']:
+    """
+    Get the Flow object for a flow descriptor
+
+    :param fd: The flow descriptor
+    :return:   The Flow that allocated, accepted or joined it, or None
+    """
+
+    return _flows.get(fd)
+
+
 class Flow:
 
     def __init__(self):
@@ -174,8 +412,20 @@ class Flow:
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
+        _unregister_flow(self.__fd, self)
         lib.flow_dealloc(self.__fd)
 
+    def __iter__(self):
+        return self.iter_sdus()
+
+    @property
+    def fd(self) -> int:
+        """
+        The flow descriptor, -1 if the flow is not allocated
+        """
+
+        return self.__fd
+
     def alloc(self,
               dst: str,
               qos: QoSSpec = None,
@@ -200,6 +450,8 @@ class Flow:
 
         _raise(self.__fd)
 
+        _flows[self.__fd] = self
+
         return _qosspec_to_qos(_qos)
 
     def accept(self,
@@ -222,6 +474,8 @@ class Flow:
 
         _raise(self.__fd)
 
+        _flows[self.__fd] = self
+
         return _qosspec_to_qos(_qos)
 
     def join(self,
@@ -245,12 +499,16 @@ class Flow:
 
         _raise(self.__fd)
 
+        _flows[self.__fd] = self
+
     def dealloc(self):
         """
         Deallocate a flow
 
         """
 
+        _unregister_flow(self.__fd, self)
+
         self.__fd = lib.flow_dealloc(self.__fd)
 
         if self.__fd < 0:
@@ -260,22 +518,92 @@ class Flow:
 
     def write(self,
               buf: bytes,
-              count: int = None) -> int:
+              count: int = None,
+              timeo: float = None) -> int:
         """
         Attempt to write <count> bytes to a flow
 
         :param buf:    Buffer to write from
         :param count:  Number of bytes to write from the buffer
+        :param timeo:  Timeout for this write only (None -> flow timeout),
+                       not safe if other threads write to this flow
         :return:       Number of bytes written
         """
 
         if self.__fd < 0:
             raise FlowNotAllocatedException()
 
+        _buf = ffi.from_buffer(buf)
+
         if count is None:
-            return lib.flow_write(self.__fd, ffi.from_buffer(buf), len(buf))
+            count = len(_buf)
+
+        if timeo is None:
+            result = lib.flow_write(self.__fd, _buf, count)
+        else:
+            result = lib.flow_write_timed(self.__fd, _buf, count,
+                                          _fl_to_timespec(timeo))
 
-        return lib.flow_write(self.__fd, ffi.from_buffer(buf), count)
+        _raise(result)
+
+        return result
+
+    def try_write(self,
+                  buf: bytes,
+                  count: int = None) -> Optional[int]:
+        """
+        Attempt to write <count> bytes to a flow, without raising if the
+        write would block
+
+        :param buf:    Buffer to write from
+        :param count:  Number of bytes to write from the buffer
+        :return:       Number of bytes written, None if it would block
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        _buf = ffi.from_buffer(buf)
+
+        if count is None:
+            count = len(_buf)
+
+        result = lib.flow_write(self.__fd, _buf, count)
+        if result == -errno.EAGAIN:
+            return None
+
+        _raise(result)
+
+        return result
+
+    def write_many(self,
+                   bufs) -> list:
+        """
+        Attempt to write a batch of SDUs to a flow in a single call
+
+        The buffers are written in place, without copying them. The
+        batch stops at the first write that fails, e.g. would block.
+
+        :param bufs:   Iterable of buffers, each written as one SDU
+        :return:       Number of bytes written per SDU, for the SDUs
+                       that were written
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        _bufs = [ffi.from_buffer(b) for b in bufs]
+        if not _bufs:
+            return []
+
+        _lens = ffi.new("size_t []", [len(b) for b in _bufs])
+        _ptrs = ffi.new("const void *[]", _bufs)
+
+        result = lib.flow_write_many(self.__fd, _ptrs, _lens, len(_bufs))
+
+        _raise(result)
+
+        return list(_lens[0:result])
 
     def writeline(self,
                   ln: str) -> int:
@@ -292,11 +620,14 @@ class Flow:
         return self.write(ln.encode(), len(ln))
 
     def read(self,
-             count: int = None) -> bytes:
+             count: int = None,
+             timeo: float = None) -> bytes:
         """
         Attempt to read bytes from a flow
 
         :param count:   Maximum number of bytes to read
+        :param timeo:   Timeout for this read only (None -> flow timeout),
+                        not safe if other threads read from this flow
         :return:        Bytes read
         """
 
@@ -306,11 +637,166 @@ class Flow:
         if count is None:
             count = 2048
 
-        _buf = ffi.new("char []", count)
+        _buf = read_pool.get(count)
+
+        try:
+            if timeo is None:
+                result = lib.flow_read(self.__fd, _buf, count)
+            else:
+                result = lib.flow_read_timed(self.__fd, _buf, count,
+                                             _fl_to_timespec(timeo))
+
+            _raise(result)
+
+            return ffi.unpack(_buf, result)
+        finally:
+            read_pool.put(_buf)
+
+    def try_read(self,
+                 count: int = None) -> Optional[bytes]:
+        """
+        Attempt to read bytes from a flow, without raising if the read
+        would block
+
+        :param count:   Maximum number of bytes to read
+        :return:        Bytes read, None if it would block
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        if count is None:
+            count = 2048
+
+        _buf = read_pool.get(count)
+
+        try:
+            result = lib.flow_read(self.__fd, _buf, count)
+            if result == -errno.EAGAIN:
+                return None
+
+            _raise(result)
+
+            return ffi.unpack(_buf, result)
+        finally:
+            read_pool.put(_buf)
+
+    def try_readinto(self,
+                     buf) -> Optional[int]:
+        """
+        Attempt to read bytes from a flow into a writable buffer, without
+        raising if the read would block
+
+        :param buf:     Writable buffer (bytearray, memoryview, mmap, ...)
+        :return:        Number of bytes read, None if it would block
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        _buf = ffi.from_buffer(buf, require_writable=True)
+
+        result = lib.flow_read(self.__fd, _buf, len(_buf))
+        if result == -errno.EAGAIN:
+            return None
+
+        _raise(result)
+
+        return result
+
+    def readinto(self,
+                 buf,
+                 timeo: float = None) -> int:
+        """
+        Attempt to read bytes from a flow into a writable buffer
+
+        :param buf:     Writable buffer (bytearray, memoryview, mmap, ...)
+        :param timeo:   Timeout for this read only (None -> flow timeout),
+                        not safe if other threads read from this flow
+        :return:        Number of bytes read
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        _buf = ffi.from_buffer(buf, require_writable=True)
+
+        if timeo is None:
+            result = lib.flow_read(self.__fd, _buf, len(_buf))
+        else:
+            result = lib.flow_read_timed(self.__fd, _buf, len(_buf),
+                                         _fl_to_timespec(timeo))
+
+        _raise(result)
+
+        return result
+
+    def recv_into(self,
+                  buf,
+                  count: int = None,
+                  offset: int = 0) -> int:
+        """
+        Attempt to read up to <count> bytes from a flow into a writable
+        buffer, starting at <offset> in that buffer
+
+        :param buf:     Writable buffer (bytearray, memoryview, mmap, ...)
+        :param count:   Maximum number of bytes to read (None -> rest of buf)
+        :param offset:  Offset in the buffer to start writing at
+        :return:        Number of bytes read
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        _buf = ffi.from_buffer(buf, require_writable=True)
+
+        if offset < 0 or offset > len(_buf):
+            raise ValueError("offset out of range")
+
+        if count is None:
+            count = len(_buf) - offset
+        elif count < 0 or offset + count > len(_buf):
+            raise ValueError("count out of range")
+
+        result = lib.flow_read(self.__fd, _buf + offset, count)
+
+        _raise(result)
+
+        return result
+
+    def read_many(self,
+                  max_sdus: int,
+                  buf) -> list:
+        """
+        Attempt to read a batch of SDUs from a flow in a single call
+
+        The buffer is split in <max_sdus> slots of equal size, SDU i is
+        read into slot i. Only the first read blocks (if the flow is
+        blocking), after that only SDUs that are already queued are read.
+
+        :param max_sdus: Maximum number of SDUs to read
+        :param buf:      Writable buffer to read the SDUs into
+        :return:         List of memoryviews on buf, one per SDU read
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        _buf = ffi.from_buffer(buf, require_writable=True)
+
+        slot = len(_buf) // max_sdus if max_sdus > 0 else 0
+        if slot == 0:
+            raise ValueError("Buffer too small for max_sdus")
+
+        _lens = ffi.new("size_t []", max_sdus)
+
+        result = lib.flow_read_many(self.__fd, _buf, slot, _lens, max_sdus)
+
+        _raise(result)
 
-        result = lib.flow_read(self.__fd, _buf, count)
+        view = memoryview(buf).cast('B')
 
-        return ffi.unpack(_buf, result)
+        return [view[i * slot:i * slot + _lens[i]] for i in range(result)]
 
     def readline(self):
         """
@@ -322,6 +808,140 @@ class Flow:
 
         return self.read().decode()
 
+    def iter_sdus(self,
+                  bufsize: int = 2048,
+                  copy: bool = False):
+        """
+        Iterate over the SDUs received on a flow, until it goes down or
+        is deallocated
+
+        Without copy, a single buffer is used for the whole iteration
+        and each memoryview is only valid until the next SDU.
+
+        :param bufsize: Maximum number of bytes per SDU
+        :param copy:    Yield owned bytes instead of memoryviews
+        :return:        Generator yielding the SDUs
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        buf = bytearray(bufsize)
+        _buf = ffi.from_buffer(buf)
+        view = memoryview(buf)
+
+        while self.__fd >= 0:
+            result = lib.flow_read(self.__fd, _buf, bufsize)
+            if result < 0:
+                if self.__fd < 0 or result == -lib.ENOTALLOC or \
+                        result == -lib.EFLOWDOWN or result == -lib.EFLOWPEER:
+                    return
+                _raise(result)
+
+            if copy:
+                yield ffi.unpack(_buf, result)
+            else:
+                yield view[:result]
+
+    def send_file(self,
+                  file,
+                  offset: int = 0,
+                  count: int = None,
+                  sdu_size: int = 8192,
+                  progress=None) -> int:
+        """
+        Send (part of) a file over a flow, without copying it into Python
+
+        The file is memory-mapped and written in SDUs of up to sdu_size
+        bytes. The transfer stops early if the flow goes down, a write
+        times out or, on a non-blocking flow, would block. To resume it,
+        call again with the offset that was returned.
+
+        :param file:     Path, file descriptor or file object to send
+        :param offset:   Offset in the file to start at
+        :param count:    Number of bytes to send (None -> until EOF)
+        :param sdu_size: Maximum number of bytes per SDU
+        :param progress: Called as progress(offset, end) after each SDU
+        :return:         Offset in the file up to which data was sent
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        with _open_file(file, os.O_RDONLY) as fd:
+            size = os.fstat(fd).st_size
+            if offset < 0 or offset > size:
+                raise ValueError("offset out of range")
+
+            end = size if count is None else min(size, offset + count)
+            if end == offset:
+                return offset
+
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            with mmap.mmap(fd, end - start, access=mmap.ACCESS_READ,
+                           offset=start) as mm, memoryview(mm) as view:
+                pos = offset - start
+                try:
+                    while offset < end:
+                        n = self.write(view[pos:pos + min(sdu_size,
+                                                          end - offset)])
+                        pos += n
+                        offset += n
+                        if progress is not None:
+                            progress(offset, end)
+                except (FlowDownException, TimeoutError, BlockingIOError):
+                    pass
+
+        return offset
+
+    def recv_file(self,
+                  path,
+                  size: int,
+                  offset: int = 0,
+                  progress=None) -> int:
+        """
+        Receive a file of a known size from a flow into a memory-mapped file
+
+        SDUs are read straight into the mapping. The transfer stops early
+        if the flow goes down, a read times out or, on a non-blocking
+        flow, would block. To resume it, call again with the offset that
+        was returned.
+
+        :param path:     Path of the file to write, created if needed
+        :param size:     Size of the file
+        :param offset:   Offset in the file to start at
+        :param progress: Called as progress(offset, size) after each SDU
+        :return:         Offset up to which the file was received,
+                         less than size if the transfer stopped early
+        """
+
+        if self.__fd < 0:
+            raise FlowNotAllocatedException()
+
+        if offset < 0 or offset > size:
+            raise ValueError("offset out of range")
+
+        with _open_file(path, os.O_RDWR | os.O_CREAT) as fd:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+
+            if offset == size:
+                return offset
+
+            with mmap.mmap(fd, size, access=mmap.ACCESS_WRITE) as mm:
+                with memoryview(mm) as view:
+                    try:
+                        while offset < size:
+                            offset += self.readinto(view[offset:])
+                            if progress is not None:
+                                progress(offset, size)
+                    except (FlowDownException, TimeoutError,
+                            BlockingIOError):
+                        pass
+                mm.flush()
+
+        return offset
+
     # flow manipulation
     def set_snd_timeout(self,
                         timeo: float):
@@ -392,7 +1012,7 @@ class Flow:
         if lib.flow_get_rx_qlen(self.__fd, size) != 0:
             raise FlowPermissionException()
 
-        return int(size)
+        return int(size[0])
 
     def get_tx_queue_len(self) -> int:
         """
@@ -405,7 +1025,7 @@ class Flow:
         if lib.flow_get_tx_qlen(self.__fd, size) != 0:
             raise FlowPermissionException()
 
-        return int(size)
+        return int(size[0])
 
     def set_flags(self, flags: FlowProperties):
         """
@@ -19,8 +19,16 @@
 # Foundation, Inc., http://www.fsf.org/about/contact/.
 #
 
+import selectors
+import threading
+import time
+import weakref
+from collections import deque
+from collections.abc import Mapping
+from math import modf
+
 from ouroboros.dev import *
-from ouroboros.dev import _fl_to_timespec
+from ouroboros.dev import _dealloc_hooks, _fl_to_timespec
 
 
 # async API
@@ -37,6 +45,21 @@ class FEventType(IntFlag):
     FlowPeer = lib.FLOW_PEER
 
 
+# Lookup table, avoids constructing an FEventType per event
+_FEVENT_TYPES = {int(t): t for t in FEventType}
+
+# Number of events moved out of an FEventQueue per call into the library
+FQUEUE_DRAIN_SIZE = 256
+
+
+def _fd_to_flow(fd: int) -> Flow:
+    f = get_flow(fd)
+    if f is None:
+        f = Flow()
+        f._Flow__fd = fd
+    return f
+
+
 class FEventQueue:
     """
     A queue of events waiting to be handled
@@ -47,6 +70,12 @@ class FEventQueue:
         if self.__fq is ffi.NULL:
             raise MemoryError("Failed to create FEventQueue")
 
+        self.__fds = ffi.new("int []", FQUEUE_DRAIN_SIZE)
+        self.__types = ffi.new("int []", FQUEUE_DRAIN_SIZE)
+
+    def __iter__(self):
+        return iter(self.drain())
+
     def __del__(self):
         lib.fqueue_destroy(self.__fq)
 
@@ -55,41 +84,139 @@ class FEventQueue:
         Get the next event
         :return: Flow and eventtype on that flow
         """
-        f = Flow()
-        f._Flow__fd = lib.fqueue_next(self.__fq)
-        if f._Flow__fd < 0:
+        fd = lib.fqueue_next(self.__fq)
+        if fd < 0:
             raise FlowEventError
 
         _type = lib.fqueue_type(self.__fq)
         if _type < 0:
             raise FlowEventError
 
-        return f, _type
+        return _fd_to_flow(fd), _type
+
+    def drain(self) -> list:
+        """
+        Get all pending events
+
+        :return: List of (flow descriptor, FEventType) tuples
+        """
+
+        events = []
+        fds = self.__fds
+        types = self.__types
+
+        while True:
+            n = lib.fqueue_drain(self.__fq, fds, types, FQUEUE_DRAIN_SIZE)
+            events.extend(zip(ffi.unpack(fds, n),
+                              map(_FEVENT_TYPES.__getitem__,
+                                  ffi.unpack(types, n))))
+            if n < FQUEUE_DRAIN_SIZE:
+                return events
+
+    def drain_flows(self) -> list:
+        """
+        Get all pending events, with the Flow objects they occurred on
+
+        :return: List of (Flow, FEventType) tuples
+        """
+
+        return [(_fd_to_flow(fd), t) for fd, t in self.drain()]
+
+
+# FlowSets each flow descriptor is in, to drop deallocated flows
+_fd_sets = dict()
+_fd_sets_lock = threading.Lock()
+
+
+def _track(fset, fds) -> None:
+    with _fd_sets_lock:
+        for fd in fds:
+            sets = _fd_sets.get(fd)
+            if sets is None:
+                sets = _fd_sets[fd] = weakref.WeakSet()
+            sets.add(fset)
+
+
+def _untrack(fset, fds) -> None:
+    with _fd_sets_lock:
+        for fd in fds:
+            sets = _fd_sets.get(fd)
+            if sets is not None:
+                sets.discard(fset)
+                if not sets:
+                    del _fd_sets[fd]
+
+
+def _remove_deallocated(fd: int) -> None:
+    with _fd_sets_lock:
+        sets = _fd_sets.pop(fd, None)
+
+    if sets is not None:
+        for fset in list(sets):
+            fset._FlowSet__forget(fd)
+
+
+_dealloc_hooks.append(_remove_deallocated)
 
 
 class FlowSet:
     """
     A set of flows that can be monitored for events
+
+    Flows that are deallocated through their Flow object are removed
+    from all sets they are in.
     """
     def __init__(self,
-                 flows: [Flow] = None):
+                 flows: [Flow] = None,
+                 wakeable: bool = False):
+        """
+        :param flows:    Flows to add to the set
+        :param wakeable: Allow wakeup(), see wakeup()
+        """
 
+        self.__wake = ffi.new("int *") if wakeable else None
+        self.__fds = set()
         self.__set = lib.fset_create()
         if self.__set is ffi.NULL:
             raise MemoryError("Failed to create FlowSet")
 
         if flows is not None:
-            for flow in flows:
-                if lib.fset_add(self.__set, flow._Flow__fd) != 0:
-                    lib.fset_destroy(self.__set)
-                    self.__set = ffi.NULL
-                    raise MemoryError("Failed to add flow " + str(flow._Flow__fd) + ".")
+            try:
+                self.add_many(flows)
+            except MemoryError:
+                self.destroy()
+                raise
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
-        lib.fset_destroy(self.__set)
+        self.destroy()
+
+    def __contains__(self,
+                     flow: Flow) -> bool:
+        if self.__set is ffi.NULL or flow._Flow__fd < 0:
+            return False
+
+        return bool(lib.fset_has(self.__set, flow._Flow__fd))
+
+    def __len__(self) -> int:
+        return len(self.__fds)
+
+    def __iter__(self):
+        """
+        Iterate over the flows in the set, see get_flow()
+        """
+
+        for fd in list(self.__fds):
+            yield _fd_to_flow(fd)
+
+    def __forget(self,
+                 fd: int) -> None:
+        if fd in self.__fds:
+            self.__fds.discard(fd)
+            if self.__set is not ffi.NULL:
+                lib.fset_del(self.__set, fd)
 
     def add(self,
             flow: Flow):
@@ -102,9 +229,36 @@ class FlowSet:
         if self.__set is ffi.NULL:
             raise ValueError
 
-        if lib.fset_add(self.__set, flow._Flow__fd) != 0:
+        fd = flow._Flow__fd
+        if lib.fset_add(self.__set, fd) != 0:
             raise MemoryError("Failed to add flow")
 
+        self.__fds.add(fd)
+        _track(self, (fd,))
+
+    def add_many(self,
+                 flows: [Flow]):
+        """
+        Add a number of Flows in one call
+
+        :param flows: The flow objects to add
+        """
+
+        if self.__set is ffi.NULL:
+            raise ValueError
+
+        fds = [flow._Flow__fd for flow in flows]
+        if not fds:
+            return
+
+        n = lib.fset_add_many(self.__set, ffi.new("int[]", fds), len(fds))
+
+        self.__fds.update(fds[:n])
+        _track(self, fds[:n])
+
+        if n < len(fds):
+            raise MemoryError("Failed to add flow " + str(fds[n]) + ".")
+
     def zero(self):
         """
         Remove all Flows from this set
@@ -115,6 +269,9 @@ class FlowSet:
 
         lib.fset_zero(self.__set)
 
+        _untrack(self, self.__fds)
+        self.__fds.clear()
+
     def remove(self,
                flow: Flow):
         """
@@ -126,13 +283,44 @@ class FlowSet:
         if self.__set is ffi.NULL:
             raise ValueError
 
-        lib.fset_del(self.__set, flow._Flow__fd)
+        self.__remove_fd(flow._Flow__fd)
+
+    def __remove_fd(self,
+                    fd: int) -> None:
+        lib.fset_del(self.__set, fd)
+
+        if fd in self.__fds:
+            self.__fds.discard(fd)
+            _untrack(self, (fd,))
+
+    def remove_many(self,
+                    flows: [Flow]):
+        """
+        Remove a number of Flows in one call
+
+        :param flows: The flow objects to remove
+        """
+
+        if self.__set is ffi.NULL:
+            raise ValueError
+
+        fds = [flow._Flow__fd for flow in flows]
+        if not fds:
+            return
+
+        lib.fset_del_many(self.__set, ffi.new("int[]", fds), len(fds))
+
+        fds = [fd for fd in fds if fd in self.__fds]
+        self.__fds.difference_update(fds)
+        _untrack(self, fds)
 
     def wait(self,
              fq: FEventType,
              timeo: float = None):
         """
         Wait for at least one event on one of the monitored flows
+
+        Returns early, without events, if wakeup() is called.
         """
 
         if self.__set is ffi.NULL:
@@ -140,9 +328,1159 @@ class FlowSet:
 
         _timeo = _fl_to_timespec(timeo)
 
-        ret = lib.fevent(self.__set, fq._FEventQueue__fq, _timeo)
-        if ret < 0:
+        if self.__wake is None:
+            ret = lib.fevent(self.__set, fq._FEventQueue__fq, _timeo)
+        else:
+            ret = lib.fevent_wakeable(self.__set, fq._FEventQueue__fq,
+                                      _timeo, self.__wake)
+        if ret < 0 and ret != -errno.ECANCELED:
             raise FlowEventError
 
+    @property
+    def wakeable(self) -> bool:
+        return self.__wake is not None
+
+    def wakeup(self) -> None:
+        """
+        Make a wait() on this set return, from any thread
+
+        If no thread is waiting, the next wait() returns immediately.
+        Only for sets created with wakeable=True: their wait() blocks in
+        slices of 10 ms to check for a wakeup, which costs a thread
+        wakeup per slice while the set is idle.
+        """
+
+        if self.__wake is None:
+            raise ValueError("FlowSet is not wakeable")
+
+        self.__wake[0] = 1
+
     def destroy(self):
+        if self.__set is ffi.NULL:
+            return
+
+        _untrack(self, self.__fds)
+        self.__fds.clear()
+
         lib.fset_destroy(self.__set)
+        self.__set = ffi.NULL
+
+
+def _dealloc_quietly(flow: Flow) -> None:
+    try:
+        flow.dealloc()
+    except (FlowException, FlowDeallocWarning):
+        pass
+
+
+def _alloc_async(dsts: [str],
+                 qos: QoSSpec,
+                 timeo: Optional[float]) -> list:
+    """
+    Allocate a flow to each destination in dsts, in parallel
+
+    :return: List with a Flow or an exception per destination
+    """
+
+    results = [None] * len(dsts)
+    pending = dict()
+
+    fq = FEventQueue()
+    with FlowSet() as fs:
+        for i, dst in enumerate(dsts):
+            f = Flow()
+            try:
+                f.alloc(dst, qos, 0)
+            except Exception as e:
+                results[i] = e
+                continue
+            pending[f.fd] = (i, f)
+            fs.add(f)
+
+        if timeo is not None:
+            deadline = time.monotonic() + timeo
+
+        while pending:
+            left = None
+            if timeo is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+            try:
+                fs.wait(fq, left)
+            except FlowEventError:
+                break
+
+            for fd, t in fq.drain():
+                if fd not in pending:
+                    continue
+                if t == FEventType.FlowAlloc:
+                    i, f = pending.pop(fd)
+                    fs.remove(f)
+                    results[i] = f
+                elif t & (FEventType.FlowDealloc | FEventType.FlowDown):
+                    i, f = pending.pop(fd)
+                    results[i] = FlowException(errno.ECONNREFUSED,
+                                               "Flow allocation failed")
+                    _dealloc_quietly(f)
+
+    for i, f in pending.values():
+        results[i] = TimeoutError(errno.ETIMEDOUT,
+                                  "Flow allocation timed out")
+        _dealloc_quietly(f)
+
+    return results
+
+
+def alloc_many(dsts: [str],
+               qos: QoSSpec = None,
+               timeo: float = None) -> tuple:
+    """
+    Allocate flows to a number of destinations in parallel
+
+    All allocations are started asynchronously and completed through
+    FlowAlloc events, so this takes about as long as the slowest one.
+
+    :param dsts:  The destination names
+    :param qos:   The QoS for the requested flows
+    :param timeo: The timeout for all allocations (None -> forever)
+    :return:      Dict of Flows and dict of exceptions, by destination
+    """
+
+    flows = dict()
+    errors = dict()
+
+    dsts = list(dict.fromkeys(dsts))
+    for dst, result in zip(dsts, _alloc_async(dsts, qos, timeo)):
+        if isinstance(result, Flow):
+            flows[dst] = result
+        else:
+            errors[dst] = result
+
+    return flows, errors
+
+
+# Events that make a flow readable for a FlowSelector
+_FLOW_READ_EVENTS = FEventType.FlowPkt | FEventType.FlowDown | \
+    FEventType.FlowDealloc | FEventType.FlowPeer
+
+# Maximum time a FlowSelector waits on flows while it also monitors
+# other file objects (s)
+FLOW_SELECTOR_POLL = 0.01
+
+
+# FlowSelectors, to drop deallocated flows
+_selectors = weakref.WeakSet()
+
+
+def _drop_deallocated_keys(fd: int) -> None:
+    for sel in list(_selectors):
+        sel._FlowSelector__forget(fd)
+
+
+_dealloc_hooks.append(_drop_deallocated_keys)
+
+
+class _FlowSelectorMapping(Mapping):
+
+    def __init__(self, flows: dict, other: selectors.BaseSelector):
+        self.__flows = flows
+        self.__other = other
+
+    def __len__(self):
+        return len(self.__flows) + len(self.__other.get_map())
+
+    def __getitem__(self, fileobj):
+        if isinstance(fileobj, Flow):
+            return self.__flows[fileobj]
+        return self.__other.get_map()[fileobj]
+
+    def __iter__(self):
+        yield from list(self.__flows)
+        yield from self.__other.get_map()
+
+
+class FlowSelector(selectors.BaseSelector):
+    """
+    A selector over Flows, built on a FlowSet and an FEventQueue
+
+    A flow is readable when packets are pending or it went down. As
+    Ouroboros has no event for writability, flows registered for
+    EVENT_WRITE are always reported writable.
+
+    Other file objects (sockets, pipes, ...) are handed to a default
+    selector. When both are registered, select() alternates between them,
+    waiting at most FLOW_SELECTOR_POLL seconds on the flows at a time.
+
+    A flow that is deallocated is no longer selected, but stays
+    registered until it is unregistered.
+    """
+
+    def __init__(self):
+        self.__set = FlowSet()
+        self.__fq = FEventQueue()
+        self.__flows = dict()       # Flow -> key, also once deallocated
+        self.__keys = dict()        # fd -> key, allocated flows
+        self.__writers = dict()
+        self.__pending = set()
+        self.__qlen = ffi.new("size_t *")
+        self.__other = selectors.DefaultSelector()
+        self.__map = _FlowSelectorMapping(self.__flows, self.__other)
+        _selectors.add(self)
+
+    def __forget(self,
+                 fd: int) -> None:
+        # the flow was deallocated, the fd may be reused
+        self.__keys.pop(fd, None)
+        self.__writers.pop(fd, None)
+        self.__pending.discard(fd)
+
+    def register(self, fileobj, events, data=None) -> selectors.SelectorKey:
+        if not isinstance(fileobj, Flow):
+            return self.__other.register(fileobj, events, data)
+
+        if not events or events & ~(selectors.EVENT_READ |
+                                    selectors.EVENT_WRITE):
+            raise ValueError(f"Invalid events: {events!r}")
+
+        fd = fileobj.fd
+        if fd < 0:
+            raise FlowNotAllocatedException()
+        if fd in self.__keys or fileobj in self.__flows:
+            raise KeyError(f"{fileobj!r} (FD {fd}) is already registered")
+
+        key = selectors.SelectorKey(fileobj, fd, events, data)
+
+        self.__set.add(fileobj)
+        self.__flows[fileobj] = key
+        self.__keys[fd] = key
+        if events & selectors.EVENT_WRITE:
+            self.__writers[fd] = key
+        # packets may be pending from before the flow was added
+        self.__pending.add(fd)
+
+        return key
+
+    def unregister(self, fileobj) -> selectors.SelectorKey:
+        if not isinstance(fileobj, Flow):
+            return self.__other.unregister(fileobj)
+
+        key = self.__flows.pop(fileobj)
+
+        if self.__keys.get(key.fd) is key:
+            self.__forget(key.fd)
+            self.__set.remove(fileobj)
+
+        return key
+
+    def modify(self, fileobj, events, data=None) -> selectors.SelectorKey:
+        if not isinstance(fileobj, Flow):
+            return self.__other.modify(fileobj, events, data)
+
+        key = self.__flows[fileobj]
+        if events == key.events:
+            key = key._replace(data=data)
+            self.__flows[fileobj] = key
+            if key.fd in self.__keys:
+                self.__keys[key.fd] = key
+            if key.fd in self.__writers:
+                self.__writers[key.fd] = key
+            return key
+
+        self.unregister(fileobj)
+        return self.register(fileobj, events, data)
+
+    def __readable(self, fd: int) -> bool:
+        return lib.flow_get_rx_qlen(fd, self.__qlen) == 0 and \
+            self.__qlen[0] > 0
+
+    def select(self, timeout=None) -> list:
+        if not self.__keys:
+            return self.__other.select(timeout)
+
+        ready = dict()
+
+        # fevent reports new packets, keep reporting unread ones
+        for fd in list(self.__pending):
+            if self.__readable(fd):
+                ready[fd] = selectors.EVENT_READ
+
+        for fd in list(self.__writers):
+            ready[fd] = ready.get(fd, 0) | selectors.EVENT_WRITE
+
+        other = []
+        if self.__other.get_map():
+            other = self.__other.select(0)
+            if other or ready:
+                timeout = 0
+            elif timeout is None or timeout > FLOW_SELECTOR_POLL:
+                timeout = FLOW_SELECTOR_POLL
+        elif ready:
+            timeout = 0
+
+        try:
+            self.__set.wait(self.__fq, timeout)
+            for fd, t in self.__fq.drain():
+                if t & _FLOW_READ_EVENTS and fd in self.__keys:
+                    ready[fd] = ready.get(fd, 0) | selectors.EVENT_READ
+        except FlowEventError:
+            pass
+
+        if not other and not ready and self.__other.get_map():
+            other = self.__other.select(0)
+
+        self.__pending = set(fd for fd, ev in ready.items()
+                             if ev & selectors.EVENT_READ)
+
+        events = []
+        for fd, ev in ready.items():
+            key = self.__keys.get(fd)
+            if key is not None and ev & key.events:
+                events.append((key, ev & key.events))
+
+        return events + other
+
+    def close(self) -> None:
+        _selectors.discard(self)
+        self.__flows.clear()
+        self.__keys.clear()
+        self.__writers.clear()
+        self.__pending.clear()
+        self.__other.close()
+        self.__set.destroy()
+
+    def get_map(self) -> Mapping:
+        return self.__map
+
+
+# Timer wheel geometry: 256 slots on the first level, 64 on the others
+_TW_L0_BITS = 8
+_TW_LN_BITS = 6
+_TW_LEVELS = 4
+_TW_L0_SIZE = 1 << _TW_L0_BITS
+_TW_LN_SIZE = 1 << _TW_LN_BITS
+_TW_MAX_TICKS = 1 << (_TW_L0_BITS + (_TW_LEVELS - 1) * _TW_LN_BITS)
+
+# Default resolution of a TimerWheel (s)
+TIMER_TICK = 0.001
+
+
+class Timer:
+    """
+    A timer in a TimerWheel, see TimerWheel.call_later()
+    """
+
+    __slots__ = ('expires', 'interval', 'callback', 'args',
+                 '_wheel', '_slot')
+
+    def __init__(self, wheel, expires: int, interval: int, callback, args):
+        self.expires = expires
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+        self._slot = None
+
+    def cancel(self) -> None:
+        """
+        Cancel the timer, a no-op if it already fired or was cancelled
+        """
+
+        self._wheel.cancel(self)
+
+    def active(self) -> bool:
+        """
+        :return: True if the timer will still fire
+        """
+
+        return self._slot is not None
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel with O(1) insertion and cancellation
+
+    Time is counted in ticks of <tick> seconds. Timers less than 256
+    ticks away sit in the first level, timers further away on coarser
+    levels of 64 slots each, and move down a level as their slot comes
+    up. Timers fire at the first advance() at or after their expiry.
+    """
+
+    def __init__(self,
+                 tick: float = TIMER_TICK):
+        """
+        :param tick: The resolution of the wheel (s)
+        """
+
+        self.__tick = tick
+        self.__start = time.monotonic()
+        self.__now = 0
+        self.__count = 0
+        self.__levels = [[set() for _ in range(_TW_L0_SIZE)]] + \
+            [[set() for _ in range(_TW_LN_SIZE)]
+             for _ in range(_TW_LEVELS - 1)]
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def __ticks(self, now: float) -> int:
+        return int((now - self.__start) / self.__tick)
+
+    def __insert(self, timer: Timer) -> None:
+        delta = timer.expires - self.__now
+        if delta < _TW_L0_SIZE:
+            slot = self.__levels[0][timer.expires & (_TW_L0_SIZE - 1)]
+        else:
+            delta = min(delta, _TW_MAX_TICKS - 1)
+            expires = self.__now + delta
+            level = 1
+            shift = _TW_L0_BITS
+            while delta >= 1 << (shift + _TW_LN_BITS):
+                level += 1
+                shift += _TW_LN_BITS
+            slot = self.__levels[level][(expires >> shift) &
+                                        (_TW_LN_SIZE - 1)]
+        slot.add(timer)
+        timer._slot = slot
+
+    def __schedule(self, delay: float, interval: float, callback, args):
+        # round up, a timer never fires early
+        expires = -(-(time.monotonic() - self.__start + delay) // self.__tick)
+        timer = Timer(self, max(int(expires), self.__now + 1),
+                      int(max(1, -(-interval // self.__tick)))
+                      if interval else 0,
+                      callback, args)
+        self.__insert(timer)
+        self.__count += 1
+        return timer
+
+    def call_later(self,
+                   delay: float,
+                   callback,
+                   *args) -> Timer:
+        """
+        Call callback(*args) once after delay seconds
+
+        :return: The Timer, which can be cancelled
+        """
+
+        return self.__schedule(delay, 0, callback, args)
+
+    def call_every(self,
+                   interval: float,
+                   callback,
+                   *args) -> Timer:
+        """
+        Call callback(*args) every interval seconds until cancelled
+
+        :return: The Timer, which can be cancelled
+        """
+
+        return self.__schedule(interval, interval, callback, args)
+
+    def cancel(self,
+               timer: Timer) -> None:
+        """
+        Cancel a timer, a no-op if it already fired or was cancelled
+
+        :param timer: The timer
+        """
+
+        if timer._slot is not None:
+            timer._slot.discard(timer)
+            timer._slot = None
+            self.__count -= 1
+        timer.interval = 0
+
+    def __cascade(self) -> None:
+        # move the timers in the next slot of each coarser level down
+        shift = _TW_L0_BITS
+        for level in range(1, _TW_LEVELS):
+            idx = (self.__now >> shift) & (_TW_LN_SIZE - 1)
+            slot = self.__levels[level][idx]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self.__insert(timer)
+            if idx != 0:
+                break
+            shift += _TW_LN_BITS
+
+    def __level0_empty(self) -> bool:
+        return not any(self.__levels[0])
+
+    def advance(self,
+                now: float = None) -> int:
+        """
+        Fire the timers that expired
+
+        :param now: time.monotonic() value to advance to (None -> now)
+        :return:    Number of timers fired
+        """
+
+        if now is None:
+            now = time.monotonic()
+
+        target = self.__ticks(now)
+        fired = 0
+
+        while self.__now < target:
+            if self.__count == 0:
+                self.__now = target
+                break
+            if self.__level0_empty():
+                # nothing to fire before the next cascade
+                nxt = (self.__now | (_TW_L0_SIZE - 1)) + 1
+                if nxt > target:
+                    self.__now = target
+                    break
+                self.__now = nxt
+            else:
+                self.__now += 1
+            if self.__now & (_TW_L0_SIZE - 1) == 0:
+                self.__cascade()
+
+            slot = self.__levels[0][self.__now & (_TW_L0_SIZE - 1)]
+            while slot:
+                timer = slot.pop()
+                timer._slot = None
+                if timer.expires > self.__now:
+                    # clamped timer, not due yet
+                    self.__insert(timer)
+                    continue
+                fired += 1
+                if timer.interval:
+                    timer.expires = self.__now + timer.interval
+                    self.__insert(timer)
+                else:
+                    self.__count -= 1
+                timer.callback(*timer.args)
+
+        return fired
+
+    def next_timeout(self,
+                     now: float = None) -> Optional[float]:
+        """
+        Time until the next advance() that can fire a timer
+
+        :param now: time.monotonic() value to compute from (None -> now)
+        :return:    Timeout in seconds, None if there are no timers
+        """
+
+        if self.__count == 0:
+            return None
+
+        if now is None:
+            now = time.monotonic()
+
+        level0 = self.__levels[0]
+        ticks = _TW_L0_SIZE - (self.__now & (_TW_L0_SIZE - 1))
+        for i in range(1, _TW_L0_SIZE):
+            if level0[(self.__now + i) & (_TW_L0_SIZE - 1)]:
+                ticks = i
+                break
+
+        expiry = self.__start + (self.__now + ticks) * self.__tick
+
+        return max(0.0, expiry - now)
+
+
+# Timeout of a single flow_accept call in the Reactor accept thread (s)
+REACTOR_ACCEPT_TIMEO = 1.0
+
+# Time the Reactor accept thread waits after flow_accept failed (s)
+REACTOR_ACCEPT_BACKOFF = 0.1
+
+
+def _report_error(e: Exception) -> None:
+    threading.excepthook(threading.ExceptHookArgs(
+        (type(e), e, e.__traceback__, threading.current_thread())))
+
+
+class Reactor:
+    """
+    Owns a FlowSet and an FEventQueue and dispatches the events on each
+    flow to the handlers registered for that flow and event type
+
+    Handlers are called as handler(flow) from the thread running the
+    reactor. A flow is removed after its FlowDealloc handler ran.
+
+    Timers set with call_later() and call_every() run from the same
+    thread, the next timer expiry bounds the wait for events.
+
+    The set is wakeable, for stop(), accept() and
+    call_soon_threadsafe(), so an idle reactor thread still wakes up
+    every 10 ms, see FlowSet.wakeup().
+    """
+
+    def __init__(self,
+                 tick: float = TIMER_TICK,
+                 on_error=None):
+        """
+        :param tick:     The resolution of the reactor timers (s)
+        :param on_error: Called as on_error(exc) when a handler, timer or
+                         callback raises, after which the reactor goes on
+                         (None -> the exception propagates from run_once())
+        """
+
+        self.__on_error = on_error
+        self.__set = FlowSet(wakeable=True)
+        self.__fq = FEventQueue()
+        self.__timers = TimerWheel(tick)
+        self.__ts = ffi.new("struct timespec *")
+        self.__calls = deque()
+        self.__flows = dict()
+        self.__accepted = deque()
+        self.__on_accept = None
+        self.__accept_thread = None
+        self.__running = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def add(self,
+            flow: Flow,
+            on_pkt=None,
+            on_down=None,
+            on_up=None,
+            on_alloc=None,
+            on_dealloc=None,
+            on_peer=None) -> None:
+        """
+        Monitor a flow and set its handlers
+
+        :param flow:       The flow
+        :param on_pkt:     Handler for FlowPkt events
+        :param on_down:    Handler for FlowDown events
+        :param on_up:      Handler for FlowUp events
+        :param on_alloc:   Handler for FlowAlloc events
+        :param on_dealloc: Handler for FlowDealloc events
+        :param on_peer:    Handler for FlowPeer events
+        """
+
+        handlers = dict()
+        for t, h in ((FEventType.FlowPkt, on_pkt),
+                     (FEventType.FlowDown, on_down),
+                     (FEventType.FlowUp, on_up),
+                     (FEventType.FlowAlloc, on_alloc),
+                     (FEventType.FlowDealloc, on_dealloc),
+                     (FEventType.FlowPeer, on_peer)):
+            if h is not None:
+                handlers[int(t)] = h
+
+        self.__flows[flow.fd] = (flow, handlers)
+        self.__set.add(flow)
+
+    def set_handler(self,
+                    flow: Flow,
+                    event: FEventType,
+                    handler) -> None:
+        """
+        Set or clear (None) the handler for one event type on a flow
+
+        :param flow:    A flow added to this reactor
+        :param event:   The event type
+        :param handler: The handler
+        """
+
+        _, handlers = self.__flows[flow.fd]
+        if handler is None:
+            handlers.pop(int(event), None)
+        else:
+            handlers[int(event)] = handler
+
+    def remove(self,
+               flow: Flow) -> None:
+        """
+        Stop monitoring a flow, call before deallocating it
+
+        :param flow: The flow
+        """
+
+        self.__remove_fd(flow.fd)
+
+    def __remove_fd(self,
+                    fd: int) -> None:
+        # by fd, for deferred calls: the flow may be deallocated by then
+        if self.__flows.pop(fd, None) is not None:
+            self.__set._FlowSet__remove_fd(fd)
+
+    def __len__(self) -> int:
+        return len(self.__flows)
+
+    @property
+    def timers(self) -> TimerWheel:
+        return self.__timers
+
+    def call_later(self,
+                   delay: float,
+                   callback,
+                   *args) -> Timer:
+        """
+        Call callback(*args) from the reactor thread after delay seconds
+
+        :return: The Timer, which can be cancelled
+        """
+
+        return self.__timers.call_later(delay, self.__call, callback, *args)
+
+    def call_every(self,
+                   interval: float,
+                   callback,
+                   *args) -> Timer:
+        """
+        Call callback(*args) from the reactor thread every interval seconds
+
+        :return: The Timer, which can be cancelled
+        """
+
+        return self.__timers.call_every(interval, self.__call, callback,
+                                        *args)
+
+    def call_soon_threadsafe(self,
+                             callback,
+                             *args) -> None:
+        """
+        Call callback(*args) from the reactor thread, can be called from
+        any thread
+        """
+
+        self.__calls.append((callback, args))
+        self.__set.wakeup()
+
+    def __call(self,
+               callback,
+               *args) -> None:
+        try:
+            callback(*args)
+        except Exception as e:
+            if self.__on_error is None:
+                raise
+            self.__on_error(e)
+
+    def __accept_loop(self) -> None:
+        while self.__on_accept is not None:
+            try:
+                f = flow_accept(REACTOR_ACCEPT_TIMEO)
+            except TimeoutError:
+                continue
+            except Exception as e:
+                _report_error(e)
+                time.sleep(REACTOR_ACCEPT_BACKOFF)
+                continue
+            self.__accepted.append(f)
+            self.__set.wakeup()
+
+    def accept(self,
+               on_accept) -> None:
+        """
+        Accept flows in a background thread and call on_accept(flow) from
+        the reactor thread for each of them, which typically adds it
+
+        Errors accepting a flow are reported with threading.excepthook,
+        after which the thread goes on accepting.
+
+        :param on_accept: Handler for accepted flows
+        """
+
+        self.__on_accept = on_accept
+        if self.__accept_thread is None:
+            self.__accept_thread = threading.Thread(target=self.__accept_loop,
+                                                    name="ouroboros-accept",
+                                                    daemon=True)
+            self.__accept_thread.start()
+
+    def __dispatch_accepted(self) -> None:
+        accepted = self.__accepted
+        while accepted:
+            f = accepted.popleft()
+            if self.__on_accept is not None:
+                self.__call(self.__on_accept, f)
+
+    def run_once(self,
+                 timeo: float = None) -> int:
+        """
+        Wait for events and dispatch them
+
+        :param timeo: Maximum time to wait for events (None -> forever)
+        :return:      Number of events
+        """
+
+        expiry = self.__timers.next_timeout()
+        if expiry is not None and (timeo is None or expiry < timeo):
+            timeo = expiry
+
+        if timeo is None:
+            _timeo = ffi.NULL
+        else:
+            # reuse one timespec, the timeout changes on every call
+            frac, whole = modf(max(timeo, 0.0))
+            self.__ts.tv_sec = int(whole)
+            self.__ts.tv_nsec = int(frac * BILLION)
+            _timeo = self.__ts
+
+        lib.fevent_wakeable(self.__set._FlowSet__set,
+                            self.__fq._FEventQueue__fq, _timeo,
+                            self.__set._FlowSet__wake)
+
+        self.__timers.advance()
+
+        calls = self.__calls
+        while calls:
+            callback, args = calls.popleft()
+            self.__call(callback, *args)
+
+        if self.__accepted:
+            self.__dispatch_accepted()
+
+        flows = self.__flows
+        events = self.__fq.drain()
+        for fd, t in events:
+            entry = flows.get(fd)
+            if entry is None:
+                continue
+            flow, handlers = entry
+            handler = handlers.get(t)
+            if handler is not None:
+                self.__call(handler, flow)
+            if t == FEventType.FlowDealloc:
+                self.remove(flow)
+
+        return len(events)
+
+    def run(self,
+            timeo: float = None) -> None:
+        """
+        Dispatch events until stop() is called
+
+        :param timeo: Maximum time to wait for events per iteration
+        """
+
+        self.__running = True
+        while self.__running:
+            self.run_once(timeo)
+
+    def stop(self) -> None:
+        """
+        Stop run(), from any thread
+        """
+
+        self.__running = False
+        self.__set.wakeup()
+
+    def close(self) -> None:
+        """
+        Stop accepting flows and release the set and queue
+        """
+
+        self.__running = False
+        self.__on_accept = None
+        if self.__accept_thread is not None:
+            self.__accept_thread.join()
+            self.__accept_thread = None
+        self.__flows.clear()
+        self.__set.destroy()
+
+
+# Placement policies of a ShardedReactor
+SHARD_HASH = 'hash'
+SHARD_LEAST_LOADED = 'least-loaded'
+
+# Difference in flows between the busiest and the idlest shard above
+# which a flow is migrated when another flow leaves
+SHARD_REBALANCE_SLACK = 2
+
+
+class ShardedReactor:
+    """
+    Partitions flows over a number of Reactors, each one running in its
+    own thread
+
+    All handlers of a flow run in the thread of the shard that owns it,
+    so per-flow state needs no locking. Flows are placed on the shard
+    with the fewest flows, or by flow descriptor with SHARD_HASH. With
+    least-loaded placement, a flow leaving the set can cause a flow on
+    the busiest shard to migrate to the idlest one.
+
+    An exception raised by a handler, timer or callback does not stop
+    the shard, it is passed to on_error.
+    """
+
+    def __init__(self,
+                 shards: int = None,
+                 placement: str = SHARD_LEAST_LOADED,
+                 tick: float = TIMER_TICK,
+                 on_error=None):
+        """
+        :param shards:    Number of shards (None -> number of CPUs)
+        :param placement: SHARD_LEAST_LOADED or SHARD_HASH
+        :param tick:      The resolution of the shard timers (s)
+        :param on_error:  Called as on_error(exc) from the shard thread
+                          (None -> report it with threading.excepthook)
+        """
+
+        if shards is None:
+            shards = os.cpu_count() or 1
+        if shards < 1:
+            raise ValueError("Need at least one shard")
+        if placement not in (SHARD_HASH, SHARD_LEAST_LOADED):
+            raise ValueError("Unknown placement policy " + str(placement))
+
+        if on_error is None:
+            on_error = _report_error
+
+        self.__placement = placement
+        self.__lock = threading.Lock()
+        self.__on_error = on_error
+        self.__reactors = tuple(Reactor(tick, on_error)
+                                for _ in range(shards))
+        self.__fds = [set() for _ in range(shards)]
+        self.__owner = dict()       # fd -> (shard, flow, handlers)
+        self.__reserved = dict()    # fd -> shard, accepted flows
+        self.__on_accept = None
+        self.__accept_thread = None
+        self.__closed = False
+        self.__threads = [threading.Thread(target=self.__run,
+                                           args=(r,),
+                                           name=f"ouroboros-shard-{i}",
+                                           daemon=True)
+                          for i, r in enumerate(self.__reactors)]
+        for t in self.__threads:
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __run(self,
+              reactor: Reactor) -> None:
+        while not self.__closed:
+            try:
+                reactor.run_once()
+            except Exception as e:
+                self.__on_error(e)
+
+    def __len__(self) -> int:
+        return len(self.__owner)
+
+    @property
+    def reactors(self) -> tuple:
+        return self.__reactors
+
+    @property
+    def loads(self) -> list:
+        """
+        Number of flows per shard
+        """
+
+        return [len(fds) for fds in self.__fds]
+
+    def __place(self,
+                fd: int) -> int:
+        if self.__placement == SHARD_HASH:
+            return fd % len(self.__reactors)
+
+        fds = self.__fds
+        return min(range(len(fds)), key=lambda i: len(fds[i]))
+
+    def shard_of(self,
+                 flow: Flow) -> Optional[int]:
+        """
+        :param flow: A flow
+        :return:     Index of the shard that owns the flow, or None
+        """
+
+        entry = self.__owner.get(flow.fd)
+
+        return None if entry is None else entry[0]
+
+    def add(self,
+            flow: Flow,
+            **handlers) -> int:
+        """
+        Place a flow on a shard and set its handlers, see Reactor.add()
+
+        :param flow:     The flow
+        :param handlers: on_pkt, on_down, ... handlers
+        :return:         Index of the shard that owns the flow
+        """
+
+        fd = flow.fd
+        with self.__lock:
+            if fd in self.__owner:
+                raise ValueError("Flow " + str(fd) + " already added")
+            shard = self.__reserved.pop(fd, None)
+            if shard is None:
+                shard = self.__place(fd)
+            self.__owner[fd] = (shard, flow, handlers)
+            self.__fds[shard].add(fd)
+
+        self.__reactors[shard].call_soon_threadsafe(self.__attach, shard,
+                                                    flow, handlers)
+
+        return shard
+
+    def __attach(self,
+                 shard: int,
+                 flow: Flow,
+                 handlers: dict) -> None:
+        fd = flow.fd
+        if self.__owner.get(fd, (None,))[0] != shard:
+            return      # removed or moved meanwhile
+
+        on_dealloc = handlers.get('on_dealloc')
+        handlers = dict(handlers,
+                        on_dealloc=lambda f: self.__dealloc(f, fd, on_dealloc))
+
+        self.__reactors[shard].add(flow, **handlers)
+
+    def __dealloc(self,
+                  flow: Flow,
+                  fd: int,
+                  on_dealloc) -> None:
+        if on_dealloc is not None:
+            on_dealloc(flow)
+        self.__forget(fd)
+
+    def __forget(self,
+                 fd: int) -> None:
+        with self.__lock:
+            entry = self.__owner.pop(fd, None)
+            if entry is None:
+                return
+            self.__fds[entry[0]].discard(fd)
+            if self.__placement == SHARD_LEAST_LOADED:
+                self.__rebalance()
+
+    def __rebalance(self) -> None:
+        fds = self.__fds
+        src = max(range(len(fds)), key=lambda i: len(fds[i]))
+        dst = min(range(len(fds)), key=lambda i: len(fds[i]))
+        if len(fds[src]) - len(fds[dst]) <= SHARD_REBALANCE_SLACK:
+            return
+
+        fd = next(iter(fds[src]))
+        _, flow, handlers = self.__owner[fd]
+        self.__owner[fd] = (dst, flow, handlers)
+        fds[src].discard(fd)
+        fds[dst].add(fd)
+
+        self.__reactors[src].call_soon_threadsafe(self.__migrate, src, dst,
+                                                  fd, flow, handlers)
+
+    def __migrate(self,
+                  src: int,
+                  dst: int,
+                  fd: int,
+                  flow: Flow,
+                  handlers: dict) -> None:
+        self.__reactors[src]._Reactor__remove_fd(fd)
+        self.__reactors[dst].call_soon_threadsafe(self.__attach, dst,
+                                                  flow, handlers)
+
+    def remove(self,
+               flow: Flow) -> None:
+        """
+        Stop monitoring a flow, call before deallocating it
+
+        Called from a handler of the flow, the flow is removed at once,
+        otherwise from the owning shard on its next iteration.
+
+        :param flow: The flow
+        """
+
+        fd = flow.fd
+        entry = self.__owner.get(fd)
+        if entry is None:
+            return
+
+        shard = entry[0]
+        reactor = self.__reactors[shard]
+        if threading.current_thread() is self.__threads[shard]:
+            reactor._Reactor__remove_fd(fd)
+        else:
+            reactor.call_soon_threadsafe(reactor._Reactor__remove_fd, fd)
+
+        self.__forget(fd)
+
+    def call_soon_threadsafe(self,
+                             flow: Flow,
+                             callback,
+                             *args) -> None:
+        """
+        Call callback(*args) from the thread of the shard owning a flow
+
+        :param flow: A flow added to this reactor
+        """
+
+        self.__reactors[self.__owner[flow.fd][0]].call_soon_threadsafe(
+            callback, *args)
+
+    def __accept_loop(self) -> None:
+        while self.__on_accept is not None:
+            try:
+                f = flow_accept(REACTOR_ACCEPT_TIMEO)
+            except TimeoutError:
+                continue
+            except Exception as e:
+                self.__on_error(e)
+                time.sleep(REACTOR_ACCEPT_BACKOFF)
+                continue
+            with self.__lock:
+                shard = self.__place(f.fd)
+                self.__reserved[f.fd] = shard
+            self.__reactors[shard].call_soon_threadsafe(self.__accepted, f)
+
+    def __accepted(self,
+                   flow: Flow) -> None:
+        fd = flow.fd
+        if self.__on_accept is not None:
+            self.__on_accept(flow)
+        with self.__lock:
+            self.__reserved.pop(fd, None)
+
+    def accept(self,
+               on_accept) -> None:
+        """
+        Accept flows in a background thread and call on_accept(flow) for
+        each of them, from the shard a subsequent add() places it on
+
+        Errors accepting a flow are passed to on_error, after which the
+        thread goes on accepting.
+
+        :param on_accept: Handler for accepted flows
+        """
+
+        self.__on_accept = on_accept
+        if self.__accept_thread is None:
+            self.__accept_thread = threading.Thread(target=self.__accept_loop,
+                                                    name="ouroboros-accept",
+                                                    daemon=True)
+            self.__accept_thread.start()
+
+    def close(self) -> None:
+        """
+        Stop accepting flows, stop the shard threads and release them
+        """
+
+        self.__on_accept = None
+        if self.__accept_thread is not None:
+            self.__accept_thread.join()
+            self.__accept_thread = None
+
+        self.__closed = True
+        for reactor in self.__reactors:
+            reactor.stop()
+        for t in self.__threads:
+            t.join()
+        for reactor in self.__reactors:
+            reactor.close()
+
+        self.__owner.clear()
+        for fds in self.__fds:
+            fds.clear()
@@ -0,0 +1,450 @@
+#
+# Ouroboros - Copyright (C) 2016 - 2026
+#
+# Python API for Ouroboros - Message framing over flows
+#
+#    Dimitri Staessens <dimitri@ouroboros.rocks>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# version 2.1 as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., http://www.fsf.org/about/contact/.
+#
+
+import struct
+import threading
+import time
+
+from ouroboros.dev import *
+
+# Default maximum SDU size, including the fragment header
+MSG_SDU_SIZE = 8192
+
+# Fragment header flags
+MSG_FIRST = 0x01
+MSG_LAST  = 0x02
+
+# First fragment: flags, total message length. Others: flags only.
+_FIRST_HDR = struct.Struct("!BI")
+_NEXT_HDR_LEN = 1
+
+MSG_MAX_LEN = 0xFFFFFFFF
+
+# Coalesced records: length, followed by the record itself
+_REC_HDR = struct.Struct("!H")
+
+# Default maximum time a record waits in a CoalescingWriter (s)
+COALESCE_DELAY = 0.001
+
+
+class MessageException(Exception):
+    pass
+
+
+class MessageFlow:
+    """
+    Sends and receives messages of any size over a Flow
+
+    Messages larger than an SDU are fragmented, each fragment carries a
+    one byte header, the first one also the total message length so the
+    receiver can reassemble into a preallocated buffer. The flow must
+    deliver SDUs reliably and in order (e.g. QoSSpec(loss=0, in_order=1)).
+    """
+
+    def __init__(self,
+                 flow: Flow,
+                 sdu_size: int = MSG_SDU_SIZE):
+        """
+        :param flow:     The flow to send messages over
+        :param sdu_size: Maximum size of the SDUs on the flow
+        """
+
+        if sdu_size <= _FIRST_HDR.size:
+            raise ValueError("SDU size too small")
+
+        self.__flow = flow
+        self.__sdu_size = sdu_size
+        self.__sdu = bytearray(sdu_size)
+
+    @property
+    def flow(self) -> Flow:
+        return self.__flow
+
+    def __write(self,
+                view: memoryview) -> None:
+        if self.__flow.write(view) != len(view):
+            raise MessageException("Short write, SDU size too large for flow")
+
+    def send(self,
+             data) -> None:
+        """
+        Send a message
+
+        :param data: Buffer with the message
+        """
+
+        src = memoryview(data).cast('B')
+        total = len(src)
+        if total > MSG_MAX_LEN:
+            raise ValueError("Message too large")
+
+        sdu = memoryview(self.__sdu)
+        hdr = _FIRST_HDR.size
+        flags = MSG_FIRST
+        off = 0
+        while True:
+            n = min(total - off, self.__sdu_size - hdr)
+            if off + n == total:
+                flags |= MSG_LAST
+            if flags & MSG_FIRST:
+                _FIRST_HDR.pack_into(sdu, 0, flags, total)
+            else:
+                sdu[0] = flags
+            sdu[hdr:hdr + n] = src[off:off + n]
+            self.__write(sdu[:hdr + n])
+            off += n
+            if flags & MSG_LAST:
+                break
+            flags = 0
+            hdr = _NEXT_HDR_LEN
+
+    def __read_first(self) -> tuple:
+        n = self.__flow.readinto(self.__sdu)
+        if n < _FIRST_HDR.size:
+            raise MessageException("Fragment too short")
+
+        flags, total = _FIRST_HDR.unpack_from(self.__sdu)
+        if not flags & MSG_FIRST:
+            raise MessageException("Expected first fragment")
+
+        return flags, total, n - _FIRST_HDR.size
+
+    def __reassemble(self,
+                     flags: int,
+                     total: int,
+                     n: int,
+                     dst: memoryview) -> None:
+        dst[:n] = self.__sdu[_FIRST_HDR.size:_FIRST_HDR.size + n]
+        off = n
+
+        # Read next fragments in place: the header lands on the last
+        # byte received so far, which is restored afterwards.
+        while not flags & MSG_LAST:
+            if off == 0:
+                n = self.__flow.readinto(self.__sdu) - _NEXT_HDR_LEN
+                flags = self.__sdu[0]
+                dst[:n] = self.__sdu[_NEXT_HDR_LEN:_NEXT_HDR_LEN + n]
+            else:
+                saved = dst[off - 1]
+                n = self.__flow.readinto(dst[off - 1:total]) - _NEXT_HDR_LEN
+                flags = dst[off - 1]
+                dst[off - 1] = saved
+            if n < 0 or flags & MSG_FIRST:
+                raise MessageException("Invalid fragment")
+            off += n
+
+        if off != total:
+            raise MessageException(f"Received {off} of {total} bytes")
+
+    def recv_into(self,
+                  buf) -> int:
+        """
+        Receive a message into a preallocated buffer
+
+        :param buf: Writable buffer, large enough for the message
+        :return:    Length of the message
+        """
+
+        flags, total, n = self.__read_first()
+
+        dst = memoryview(buf).cast('B')
+        if total > len(dst):
+            raise MessageException(f"Buffer too small for {total} bytes")
+
+        self.__reassemble(flags, total, n, dst)
+
+        return total
+
+    def recv(self) -> bytearray:
+        """
+        Receive a message
+
+        :return: The message
+        """
+
+        flags, total, n = self.__read_first()
+
+        buf = bytearray(total)
+
+        self.__reassemble(flags, total, n, memoryview(buf))
+
+        return buf
+
+    def recv_chunks(self):
+        """
+        Receive a message as a sequence of chunks, without reassembling it
+
+        The memoryviews yielded are only valid until the next chunk.
+
+        :return: Generator yielding (total length, memoryview) per chunk
+        """
+
+        flags, total, n = self.__read_first()
+
+        sdu = memoryview(self.__sdu)
+        yield total, sdu[_FIRST_HDR.size:_FIRST_HDR.size + n]
+        off = n
+
+        while not flags & MSG_LAST:
+            n = self.__flow.readinto(self.__sdu) - _NEXT_HDR_LEN
+            flags = sdu[0]
+            if n < 0 or flags & MSG_FIRST:
+                raise MessageException("Invalid fragment")
+            off += n
+            yield total, sdu[_NEXT_HDR_LEN:_NEXT_HDR_LEN + n]
+
+        if off != total:
+            raise MessageException(f"Received {off} of {total} bytes")
+
+
+def unpack_records(sdu):
+    """
+    Split an SDU written by a CoalescingWriter into its records
+
+    :param sdu: Buffer holding the SDU
+    :return:    Generator yielding a memoryview per record
+    """
+
+    view = memoryview(sdu).cast('B')
+    off = 0
+    while off < len(view):
+        if off + _REC_HDR.size > len(view):
+            raise MessageException("Truncated record header")
+        n, = _REC_HDR.unpack_from(view, off)
+        off += _REC_HDR.size
+        if off + n > len(view):
+            raise MessageException("Truncated record")
+        yield view[off:off + n]
+        off += n
+
+
+class CoalescingWriter:
+    """
+    Packs small records into SDUs of up to sdu_size bytes
+
+    Each record is prefixed with its length, so a CoalescedReader can
+    restore the record boundaries. The SDU is sent when the next record
+    does not fit, on flush(), or once the oldest record waited max_delay
+    seconds. That deadline is checked on write(); with autoflush a
+    background thread also enforces it when no more records are written.
+    An error in that thread drops the pending records and is raised by
+    the next write(), flush() or close().
+    """
+
+    def __init__(self,
+                 flow: Flow,
+                 sdu_size: int = MSG_SDU_SIZE,
+                 max_delay: float = COALESCE_DELAY,
+                 autoflush: bool = False):
+        """
+        :param flow:      The flow to write to
+        :param sdu_size:  Maximum size of the SDUs on the flow
+        :param max_delay: Maximum time a record is held back (s)
+        :param autoflush: Start a thread that flushes on the deadline
+        """
+
+        if sdu_size <= _REC_HDR.size:
+            raise ValueError("SDU size too small")
+
+        self.__flow = flow
+        self.__sdu_size = sdu_size
+        self.__max_delay = max_delay
+        self.__buf = bytearray(sdu_size)
+        self.__len = 0
+        self.__deadline = None
+        self.__error = None
+        self.__closed = False
+        self.__cond = threading.Condition()
+        self.__thread = None
+
+        if autoflush:
+            self.__thread = threading.Thread(target=self.__autoflush,
+                                             daemon=True)
+            self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """
+        time.monotonic() at which the pending records must be sent
+        """
+
+        return self.__deadline
+
+    def __check(self) -> None:
+        # raise the error the autoflush thread ran into, once
+        if self.__error is not None:
+            e, self.__error = self.__error, None
+            raise e
+
+    def __flush(self) -> None:
+        self.__check()
+        self.__send()
+
+    def __send(self) -> None:
+        # the pending records are dropped, also if the write fails
+        if self.__len == 0:
+            return
+
+        n = self.__len
+        self.__len = 0
+        self.__deadline = None
+
+        if self.__flow.write(memoryview(self.__buf)[:n]) != n:
+            raise MessageException("Short write, SDU size too large for flow")
+
+    def __autoflush(self) -> None:
+        with self.__cond:
+            while not self.__closed:
+                if self.__deadline is None:
+                    self.__cond.wait()
+                    continue
+                timeo = self.__deadline - time.monotonic()
+                if timeo > 0:
+                    self.__cond.wait(timeo)
+                    continue
+                try:
+                    self.__send()
+                except Exception as e:
+                    # drop the frames, they hold the buffer exported
+                    self.__error = e.with_traceback(None)
+
+    def write(self,
+              data) -> int:
+        """
+        Queue a record
+
+        :param data: Buffer with the record
+        :return:     Number of bytes queued
+        """
+
+        src = memoryview(data).cast('B')
+        n = len(src)
+        if _REC_HDR.size + n > self.__sdu_size:
+            raise ValueError("Record does not fit in an SDU")
+
+        with self.__cond:
+            if self.__closed:
+                raise ValueError("Writer is closed")
+
+            self.__check()
+
+            if self.__len + _REC_HDR.size + n > self.__sdu_size:
+                self.__flush()
+
+            off = self.__len
+            _REC_HDR.pack_into(self.__buf, off, n)
+            off += _REC_HDR.size
+            self.__buf[off:off + n] = src
+            self.__len = off + n
+
+            if self.__len + _REC_HDR.size > self.__sdu_size:
+                self.__flush()
+            elif self.__deadline is None:
+                self.__deadline = time.monotonic() + self.__max_delay
+                self.__cond.notify()
+            elif time.monotonic() >= self.__deadline:
+                self.__flush()
+
+        return n
+
+    def writeline(self,
+                  ln: str) -> int:
+        """
+        Queue a string as a record
+
+        :param ln:  String to write
+        :return:    Number of bytes queued
+        """
+
+        return self.write(ln.encode())
+
+    def flush(self) -> None:
+        """
+        Send the pending records now
+        """
+
+        with self.__cond:
+            self.__flush()
+
+    def close(self) -> None:
+        """
+        Send the pending records and stop the autoflush thread
+        """
+
+        with self.__cond:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__cond.notify()
+
+        if self.__thread is not None:
+            self.__thread.join()
+
+        with self.__cond:
+            self.__flush()
+
+
+class CoalescedReader:
+    """
+    Reads SDUs written by a CoalescingWriter and splits them into records
+    """
+
+    def __init__(self,
+                 flow: Flow,
+                 sdu_size: int = MSG_SDU_SIZE):
+        """
+        :param flow:     The flow to read from
+        :param sdu_size: Maximum size of the SDUs on the flow
+        """
+
+        self.__flow = flow
+        self.__buf = bytearray(sdu_size)
+
+    def read(self) -> list:
+        """
+        Read one SDU and return its records
+
+        The memoryviews returned are only valid until the next read.
+
+        :return: List of memoryviews, one per record
+        """
+
+        n = self.__flow.readinto(self.__buf)
+
+        return list(unpack_records(memoryview(self.__buf)[:n]))
+
+    def __iter__(self):
+        """
+        Iterate over the records until the flow goes down
+        """
+
+        while True:
+            try:
+                records = self.read()
+            except FlowDownException:
+                return
+            yield from records
@@ -0,0 +1,435 @@
+#
+# Ouroboros - Copyright (C) 2016 - 2026
+#
+# Python API for Ouroboros - Stream multiplexing over flows
+#
+#    Dimitri Staessens <dimitri@ouroboros.rocks>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# version 2.1 as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., http://www.fsf.org/about/contact/.
+#
+
+import struct
+import threading
+import time
+from collections import deque
+
+from ouroboros.dev import *
+
+# Default maximum SDU size, including the frame header
+MUX_SDU_SIZE = 8192
+
+# Default receive window per stream (bytes)
+MUX_WINDOW = 65536
+
+# Timeout of a single read in the demultiplexer thread (s)
+MUX_READ_TIMEO = 1.0
+
+# Frame types
+MUX_OPEN   = 0x01
+MUX_DATA   = 0x02
+MUX_CLOSE  = 0x03
+MUX_WINDOW = 0x04
+
+# Frame header: type, stream id. OPEN and WINDOW carry a window size.
+_HDR = struct.Struct("!BI")
+_WND = struct.Struct("!I")
+
+_MAX_STREAM_ID = 0xFFFFFFFF
+
+
+class MuxException(Exception):
+    pass
+
+
+class MuxStream:
+    """
+    A logical stream on a Multiplexer, see Multiplexer.open()
+
+    Data is sent within the receive window the peer grants, send()
+    blocks while it is used up. The window is handed back to the peer
+    as recv() consumes the data.
+    """
+
+    def __init__(self,
+                 mux,
+                 sid: int,
+                 credit: int,
+                 window: int):
+        self.__mux = mux
+        self.__id = sid
+        self.__cond = threading.Condition()
+        self.__queue = deque()
+        self.__queued = 0
+        self.__credit = credit
+        self.__window = window
+        self.__consumed = 0
+        self.__local_closed = False
+        self.__remote_closed = False
+        self.__error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __iter__(self):
+        """
+        Iterate over the received chunks until the peer closes
+        """
+
+        while True:
+            data = self.recv()
+            if not data:
+                return
+            yield data
+
+    @property
+    def id(self) -> int:
+        return self.__id
+
+    @property
+    def closed(self) -> bool:
+        return self.__local_closed
+
+    # called from the demultiplexer thread
+
+    def _push(self,
+              data: bytes) -> None:
+        with self.__cond:
+            self.__queued += len(data)
+            if self.__queued > self.__window:
+                self.__error = MuxException("Peer exceeded the window")
+            self.__queue.append(data)
+            self.__cond.notify_all()
+
+    def _grant(self,
+               credit: int) -> None:
+        with self.__cond:
+            self.__credit += credit
+            self.__cond.notify_all()
+
+    def _remote_close(self,
+                      error: Exception = None) -> bool:
+        with self.__cond:
+            self.__remote_closed = True
+            if error is not None and self.__error is None:
+                self.__error = error
+            self.__cond.notify_all()
+            return self.__local_closed
+
+    # application side
+
+    def send(self,
+             data,
+             timeo: float = None) -> None:
+        """
+        Send data on the stream
+
+        :param data:  Buffer with the data
+        :param timeo: Maximum time to wait for window (None -> forever)
+        """
+
+        src = memoryview(data).cast('B')
+        chunk = self.__mux.max_payload
+        deadline = None if timeo is None else time.monotonic() + timeo
+        off = 0
+
+        while off < len(src):
+            with self.__cond:
+                while self.__credit == 0 and not self.__local_closed:
+                    if self.__error is not None:
+                        raise self.__error
+                    left = None
+                    if deadline is not None:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            raise TimeoutError(errno.ETIMEDOUT,
+                                               "No window to send")
+                    self.__cond.wait(left)
+                if self.__local_closed:
+                    raise MuxException("Stream is closed")
+                n = min(len(src) - off, self.__credit, chunk)
+                self.__credit -= n
+
+            self.__mux._send(MUX_DATA, self.__id, src[off:off + n])
+            off += n
+
+    def recv(self,
+             timeo: float = None) -> bytes:
+        """
+        Receive the next chunk of data
+
+        :param timeo: Maximum time to wait (None -> forever)
+        :return:      The data, b"" once the peer closed the stream
+        """
+
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.__queue or
+                                        self.__remote_closed or
+                                        self.__error is not None, timeo):
+                raise TimeoutError(errno.ETIMEDOUT, "No data received")
+            if not self.__queue:
+                if self.__error is not None:
+                    raise self.__error
+                return b""
+            data = self.__queue.popleft()
+            self.__queued -= len(data)
+            self.__consumed += len(data)
+            grant = 0
+            if self.__consumed >= self.__window // 2:
+                grant, self.__consumed = self.__consumed, 0
+
+        if grant > 0 and not self.__remote_closed:
+            self.__mux._send(MUX_WINDOW, self.__id, _WND.pack(grant))
+
+        return data
+
+    def close(self) -> None:
+        """
+        Stop sending on the stream, the peer reads EOF
+        """
+
+        with self.__cond:
+            if self.__local_closed:
+                return
+            self.__local_closed = True
+            remote_closed = self.__remote_closed
+            self.__cond.notify_all()
+
+        if self.__error is None:
+            try:
+                self.__mux._send(MUX_CLOSE, self.__id, b"")
+            except (FlowException, MuxException):
+                pass
+
+        if remote_closed:
+            self.__mux._forget(self.__id)
+
+
+class Multiplexer:
+    """
+    Carries many logical streams over one Flow
+
+    Each SDU carries a frame of one stream, tagged with its stream id.
+    A background thread reads the flow and routes the frames to the
+    streams. Each stream has its own receive window, so a stream that
+    is not read does not hold up the others. The flow must deliver SDUs
+    reliably and in order (e.g. QoSSpec(loss=0, in_order=1)).
+
+    The side that allocated the flow should pass initiator=True, the
+    other side initiator=False, so their stream ids do not clash.
+    """
+
+    def __init__(self,
+                 flow: Flow,
+                 initiator: bool,
+                 sdu_size: int = MUX_SDU_SIZE,
+                 window: int = MUX_WINDOW):
+        """
+        :param flow:      The flow to multiplex
+        :param initiator: True on the side that allocated the flow
+        :param sdu_size:  Maximum size of the SDUs on the flow
+        :param window:    Receive window per stream (bytes)
+        """
+
+        if sdu_size <= _HDR.size + _WND.size:
+            raise ValueError("SDU size too small")
+        if window <= 0:
+            raise ValueError("Invalid window")
+
+        self.__flow = flow
+        self.__sdu_size = sdu_size
+        self.__window = window
+        self.__next_id = 1 if initiator else 2
+        self.__streams = dict()
+        self.__accepted = deque()
+        self.__lock = threading.Condition()
+        self.__wlock = threading.Lock()
+        self.__wbuf = bytearray(sdu_size)
+        self.__error = None
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__demux,
+                                         name="ouroboros-mux",
+                                         daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.__streams)
+
+    @property
+    def flow(self) -> Flow:
+        return self.__flow
+
+    @property
+    def max_payload(self) -> int:
+        return self.__sdu_size - _HDR.size
+
+    def _send(self,
+              ftype: int,
+              sid: int,
+              payload) -> None:
+        if self.__error is not None:
+            raise self.__error
+
+        n = _HDR.size + len(payload)
+        with self.__wlock:
+            _HDR.pack_into(self.__wbuf, 0, ftype, sid)
+            self.__wbuf[_HDR.size:n] = payload
+            self.__flow.write(memoryview(self.__wbuf)[:n])
+
+    def _forget(self,
+                sid: int) -> None:
+        with self.__lock:
+            self.__streams.pop(sid, None)
+
+    def open(self) -> MuxStream:
+        """
+        Open a new stream
+
+        :return: The stream
+        """
+
+        with self.__lock:
+            if self.__closed or self.__error is not None:
+                raise MuxException("Multiplexer is closed")
+            sid = self.__next_id
+            if sid > _MAX_STREAM_ID:
+                raise MuxException("Out of stream ids")
+            self.__next_id += 2
+            # no credit until the peer grants its window
+            stream = MuxStream(self, sid, 0, self.__window)
+            self.__streams[sid] = stream
+
+        self._send(MUX_OPEN, sid, _WND.pack(self.__window))
+
+        return stream
+
+    def accept(self,
+               timeo: float = None) -> MuxStream:
+        """
+        Wait for a stream opened by the peer
+
+        :param timeo: Maximum time to wait (None -> forever)
+        :return:      The stream
+        """
+
+        with self.__lock:
+            if not self.__lock.wait_for(lambda: self.__accepted or
+                                        self.__closed or
+                                        self.__error is not None, timeo):
+                raise TimeoutError(errno.ETIMEDOUT, "No stream opened")
+            if not self.__accepted:
+                raise self.__error or MuxException("Multiplexer is closed")
+            return self.__accepted.popleft()
+
+    def __frame(self,
+                ftype: int,
+                sid: int,
+                payload: memoryview) -> None:
+        if ftype == MUX_OPEN:
+            credit, = _WND.unpack_from(payload)
+            stream = MuxStream(self, sid, credit, self.__window)
+            with self.__lock:
+                if sid in self.__streams or sid % 2 == self.__next_id % 2:
+                    raise MuxException(f"Invalid stream id {sid}")
+                self.__streams[sid] = stream
+                self.__accepted.append(stream)
+                self.__lock.notify_all()
+            self._send(MUX_WINDOW, sid, _WND.pack(self.__window))
+            return
+
+        stream = self.__streams.get(sid)
+        if stream is None:
+            return      # closed meanwhile
+
+        if ftype == MUX_DATA:
+            stream._push(bytes(payload))
+        elif ftype == MUX_WINDOW:
+            credit, = _WND.unpack_from(payload)
+            stream._grant(credit)
+        elif ftype == MUX_CLOSE:
+            if stream._remote_close():
+                self._forget(sid)
+        else:
+            raise MuxException(f"Unknown frame type {ftype}")
+
+    def __demux(self) -> None:
+        buf = bytearray(self.__sdu_size)
+        view = memoryview(buf)
+        error = None
+
+        while not self.__closed:
+            try:
+                n = self.__flow.readinto(buf, MUX_READ_TIMEO)
+                if n < _HDR.size:
+                    raise MuxException("Frame too short")
+                ftype, sid = _HDR.unpack_from(buf)
+                self.__frame(ftype, sid, view[_HDR.size:n])
+            except TimeoutError:
+                continue
+            except FlowDownException as e:
+                error = MuxException("Flow down")
+                error.__cause__ = e
+                break
+            except (FlowException, MuxException, struct.error) as e:
+                error = e if isinstance(e, MuxException) else \
+                    MuxException(str(e))
+                break
+
+        if error is None:
+            return
+
+        with self.__lock:
+            self.__error = error
+            streams = list(self.__streams.values())
+            self.__streams.clear()
+            self.__lock.notify_all()
+
+        for stream in streams:
+            stream._remote_close(error)
+
+    def close(self) -> None:
+        """
+        Close all streams and stop the demultiplexer thread, the flow is
+        left allocated
+
+        Threads blocked on a stream get a MuxException.
+        """
+
+        with self.__lock:
+            if self.__closed:
+                return
+            streams = list(self.__streams.values())
+
+        for stream in streams:
+            stream.close()
+
+        with self.__lock:
+            self.__closed = True
+            streams = list(self.__streams.values())
+            self.__streams.clear()
+            self.__lock.notify_all()
+
+        error = MuxException("Multiplexer is closed")
+        for stream in streams:
+            stream._remote_close(error)
+
+        self.__thread.join()
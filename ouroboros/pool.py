@@ -0,0 +1,380 @@
+#
+# Ouroboros - Copyright (C) 2016 - 2026
+#
+# Python API for Ouroboros - Flow pools
+#
+#    Dimitri Staessens <dimitri@ouroboros.rocks>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# version 2.1 as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., http://www.fsf.org/about/contact/.
+#
+
+import contextlib
+import threading
+import time
+from collections import OrderedDict
+
+from ouroboros.event import *
+from ouroboros.event import _alloc_async, _dealloc_quietly
+
+# Default number of idle flows kept per destination and QoS
+POOL_MIN_IDLE = 0
+POOL_MAX_IDLE = 8
+
+# Default time an idle flow is kept before it is deallocated (s)
+POOL_IDLE_TIMEO = 60.0
+
+# Timeout for allocating flows to refill a key up to min_idle, when the
+# pool has no alloc_timeo (s)
+POOL_REFILL_TIMEO = 10.0
+
+
+def _qos_key(qos: Optional[QoSSpec]) -> Optional[tuple]:
+    if qos is None:
+        return None
+
+    return (qos.delay, qos.bandwidth, qos.availability, qos.loss,
+            qos.ber, qos.in_order, qos.max_gap, qos.timeout)
+
+
+class FlowPool:
+    """
+    Keeps idle flows per destination and QoS for reuse
+
+    acquire() returns the most recently released idle flow for the
+    destination and QoS, or allocates a new one, release() hands it back.
+    Idle flows are deallocated after idle_timeo seconds, and the least
+    recently used ones when there are more than max_idle per key or
+    max_total in all. A background thread monitors the idle flows and
+    discards those reported FlowDown or FlowDealloc. New flows to keep
+    at least min_idle per key are allocated from a separate thread, so
+    an unreachable destination does not hold up the pool. It waits on a
+    wakeable FlowSet, so it wakes up every 10 ms while idle.
+    """
+
+    def __init__(self,
+                 min_idle: int = POOL_MIN_IDLE,
+                 max_idle: int = POOL_MAX_IDLE,
+                 max_total: int = None,
+                 idle_timeo: float = POOL_IDLE_TIMEO,
+                 alloc_timeo: float = None):
+        """
+        :param min_idle:    Idle flows kept per key, despite idle_timeo
+        :param max_idle:    Maximum idle flows per key
+        :param max_total:   Maximum idle flows in all (None -> no limit)
+        :param idle_timeo:  Time an idle flow is kept (s, None -> forever)
+        :param alloc_timeo: Timeout for allocating a flow (None -> forever)
+        """
+
+        if min_idle < 0 or max_idle < min_idle:
+            raise ValueError("Invalid pool size")
+
+        self.__min_idle = min_idle
+        self.__max_idle = max_idle
+        self.__max_total = max_total
+        self.__idle_timeo = idle_timeo
+        self.__alloc_timeo = alloc_timeo
+
+        self.__lock = threading.Lock()
+        self.__idle = dict()            # key -> OrderedDict fd -> Flow
+        self.__order = OrderedDict()    # fd -> (key, release time)
+        self.__in_use = dict()          # Flow -> key
+        self.__specs = dict()           # key -> (dst, qos)
+        self.__refilling = set()        # keys being refilled
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__discards = 0
+        self.__evictions = 0
+
+        self.__set = FlowSet(wakeable=True)
+        self.__fq = FEventQueue()
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="ouroboros-pool",
+                                         daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.__order)
+
+    def __key(self,
+              dst: str,
+              qos: Optional[QoSSpec]) -> tuple:
+        key = (dst, _qos_key(qos))
+        if key not in self.__specs:
+            self.__specs[key] = (dst, qos)
+
+        return key
+
+    def __take(self,
+               fd: int) -> Flow:
+        # with the lock held
+        key, _ = self.__order.pop(fd)
+        idle = self.__idle[key]
+        flow = idle.pop(fd)
+        if not idle:
+            del self.__idle[key]
+        self.__set.remove(flow)
+
+        return flow
+
+    def acquire(self,
+                dst: str,
+                qos: QoSSpec = None) -> Flow:
+        """
+        Get a flow to a destination, allocating one if none is idle
+
+        :param dst: The destination name
+        :param qos: The QoS for the flow
+        :return:    The flow, to be handed back with release()
+        """
+
+        with self.__lock:
+            if self.__closed:
+                raise ValueError("Pool is closed")
+            key = self.__key(dst, qos)
+            idle = self.__idle.get(key)
+            if idle:
+                flow = self.__take(next(reversed(idle)))
+                self.__in_use[flow] = key
+                self.__hits += 1
+                return flow
+            self.__misses += 1
+
+        flow = flow_alloc(dst, qos, self.__alloc_timeo)
+
+        with self.__lock:
+            self.__in_use[flow] = key
+
+        return flow
+
+    def release(self,
+                flow: Flow,
+                discard: bool = False) -> None:
+        """
+        Hand back a flow obtained with acquire()
+
+        :param flow:    The flow
+        :param discard: Deallocate the flow instead of keeping it, e.g.
+                        after an error on it
+        """
+
+        evicted = []
+
+        with self.__lock:
+            key = self.__in_use.pop(flow, None)
+            if key is None:
+                raise ValueError("Flow not acquired from this pool")
+
+            if discard or self.__closed or flow.fd < 0:
+                self.__discards += 1
+                evicted.append(flow)
+            elif len(self.__idle.get(key, ())) >= self.__max_idle:
+                self.__evictions += 1
+                evicted.append(flow)
+            else:
+                wake = not self.__order
+                self.__idle.setdefault(key, OrderedDict())[flow.fd] = flow
+                self.__order[flow.fd] = (key, time.monotonic())
+                self.__set.add(flow)
+                if self.__max_total is not None:
+                    while len(self.__order) > self.__max_total:
+                        evicted.append(self.__take(next(iter(self.__order))))
+                        self.__evictions += 1
+                if wake:
+                    self.__set.wakeup()
+
+        for f in evicted:
+            _dealloc_quietly(f)
+
+    @contextlib.contextmanager
+    def flow(self,
+             dst: str,
+             qos: QoSSpec = None):
+        """
+        Context manager around acquire() and release(), the flow is
+        discarded if the block raises
+
+        :param dst: The destination name
+        :param qos: The QoS for the flow
+        """
+
+        flow = self.acquire(dst, qos)
+        try:
+            yield flow
+        except BaseException:
+            self.release(flow, discard=True)
+            raise
+        self.release(flow)
+
+    def prewarm(self,
+                dst: str,
+                qos: QoSSpec = None,
+                count: int = None) -> int:
+        """
+        Allocate idle flows to a destination in parallel
+
+        :param dst:   The destination name
+        :param qos:   The QoS for the flows
+        :param count: Number of idle flows wanted (None -> min_idle)
+        :return:      Number of flows added
+        """
+
+        if count is None:
+            count = self.__min_idle
+
+        return self.__fill(dst, qos, count, self.__alloc_timeo)
+
+    def __fill(self,
+               dst: str,
+               qos: Optional[QoSSpec],
+               count: int,
+               timeo: Optional[float]) -> int:
+        with self.__lock:
+            key = self.__key(dst, qos)
+            n = min(count, self.__max_idle) - len(self.__idle.get(key, ()))
+
+        if n <= 0:
+            return 0
+
+        flows = [f for f in _alloc_async([dst] * n, qos, timeo)
+                 if isinstance(f, Flow)]
+
+        with self.__lock:
+            for f in flows:
+                self.__in_use[f] = key
+
+        for f in flows:
+            self.release(f)
+
+        return len(flows)
+
+    def __discard(self,
+                  fd: int) -> None:
+        with self.__lock:
+            if fd not in self.__order:
+                return
+            key = self.__order[fd][0]
+            flow = self.__take(fd)
+            self.__discards += 1
+            refill = self.__min_idle > 0 and key not in self.__refilling \
+                and not self.__closed
+            if refill:
+                self.__refilling.add(key)
+
+        _dealloc_quietly(flow)
+
+        if refill:
+            threading.Thread(target=self.__refill,
+                             args=(key,),
+                             name="ouroboros-pool-refill",
+                             daemon=True).start()
+
+    def __refill(self,
+                 key: tuple) -> None:
+        dst, qos = self.__specs[key]
+        timeo = self.__alloc_timeo
+        if timeo is None:
+            timeo = POOL_REFILL_TIMEO
+
+        try:
+            self.__fill(dst, qos, self.__min_idle, timeo)
+        finally:
+            with self.__lock:
+                self.__refilling.discard(key)
+
+    def __expire(self) -> Optional[float]:
+        """
+        Deallocate the flows idle for too long
+
+        :return: Time until the next flow expires, None if none will
+        """
+
+        if self.__idle_timeo is None:
+            return None
+
+        expired = []
+        timeo = None
+
+        with self.__lock:
+            now = time.monotonic()
+            counts = {k: len(v) for k, v in self.__idle.items()}
+            for fd, (key, t) in list(self.__order.items()):
+                if counts[key] <= self.__min_idle:
+                    continue
+                left = t + self.__idle_timeo - now
+                if left > 0:
+                    timeo = left
+                    break
+                expired.append(self.__take(fd))
+                counts[key] -= 1
+                self.__evictions += 1
+
+        for f in expired:
+            _dealloc_quietly(f)
+
+        return timeo
+
+    def __run(self) -> None:
+        while not self.__closed:
+            timeo = self.__expire()
+            try:
+                self.__set.wait(self.__fq, timeo)
+            except FlowEventError:
+                pass
+
+            for fd, t in self.__fq.drain():
+                if t & (FEventType.FlowDown | FEventType.FlowDealloc):
+                    self.__discard(fd)
+
+    def stats(self) -> dict:
+        """
+        :return: Dict with hits, misses, discards, evictions and the
+                 number of idle and acquired flows
+        """
+
+        return {'hits': self.__hits,
+                'misses': self.__misses,
+                'discards': self.__discards,
+                'evictions': self.__evictions,
+                'idle': len(self.__order),
+                'in_use': len(self.__in_use)}
+
+    def close(self) -> None:
+        """
+        Stop the pool and deallocate the idle flows, acquired flows are
+        deallocated when they are released
+        """
+
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__set.wakeup()
+
+        self.__thread.join()
+
+        with self.__lock:
+            flows = [self.__take(fd) for fd in list(self.__order)]
+
+        for f in flows:
+            _dealloc_quietly(f)
+
+        self.__set.destroy()
@@ -0,0 +1,252 @@
+#
+# Ouroboros - Copyright (C) 2016 - 2026
+#
+# Python API for Ouroboros - Flow servers
+#
+#    Dimitri Staessens <dimitri@ouroboros.rocks>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# version 2.1 as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., http://www.fsf.org/about/contact/.
+#
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ouroboros.event import *
+from ouroboros.event import _dealloc_quietly, _report_error
+
+# Default number of accepted flows waiting for a handler
+SERVER_BACKLOG = 64
+
+# Default number of handler threads
+SERVER_WORKERS = 8
+
+# Timeout of a single flow_accept call in the accept thread (s)
+SERVER_ACCEPT_TIMEO = 1.0
+
+# Time the accept thread waits after flow_accept failed (s)
+SERVER_ACCEPT_BACKOFF = 0.1
+
+
+class FlowServer:
+    """
+    Accepts flows in a background thread and handles them on a pool of
+    threads
+
+    Accepted flows wait in a bounded backlog until a handler thread is
+    free. When the backlog is full the accept thread stops accepting, so
+    further flow requests wait in the IRMd. handler(flow) is called for
+    each flow, which is deallocated when the handler returns. Exceptions
+    raised by the handler are counted and reported with
+    threading.excepthook, as are errors accepting flows, after which the
+    server goes on accepting.
+    """
+
+    def __init__(self,
+                 handler,
+                 workers: int = SERVER_WORKERS,
+                 backlog: int = SERVER_BACKLOG,
+                 executor: ThreadPoolExecutor = None):
+        """
+        :param handler:  Called as handler(flow) for each accepted flow
+        :param workers:  Number of flows handled concurrently
+        :param backlog:  Maximum number of flows waiting for a handler
+        :param executor: Executor to run the handlers on (None -> own
+                         ThreadPoolExecutor with workers threads)
+        """
+
+        if workers < 1 or backlog < 1:
+            raise ValueError("Invalid number of workers or backlog")
+
+        self.__handler = handler
+        self.__workers = workers
+        self.__backlog = queue.Queue(backlog)
+        self.__slots = threading.Semaphore(workers)
+        self.__own_executor = executor is None
+        self.__executor = executor
+        self.__lock = threading.Lock()
+        self.__threads = []
+        self.__running = False
+
+        self.__accepted = 0
+        self.__handled = 0
+        self.__errors = 0
+        self.__active = 0
+        self.__flows = set()
+        self.__latency_sum = 0.0
+        self.__latency_max = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def start(self) -> None:
+        """
+        Start accepting and handling flows
+        """
+
+        if self.__running:
+            return
+
+        if self.__own_executor:
+            self.__executor = ThreadPoolExecutor(self.__workers,
+                                                 "ouroboros-handler")
+
+        self.__running = True
+        self.__threads = [threading.Thread(target=self.__accept_loop,
+                                           name="ouroboros-accept",
+                                           daemon=True),
+                          threading.Thread(target=self.__dispatch_loop,
+                                           name="ouroboros-dispatch",
+                                           daemon=True)]
+        for t in self.__threads:
+            t.start()
+
+    def __accept_loop(self) -> None:
+        while self.__running:
+            try:
+                f = flow_accept(SERVER_ACCEPT_TIMEO)
+            except TimeoutError:
+                continue
+            except Exception as e:
+                _report_error(e)
+                time.sleep(SERVER_ACCEPT_BACKOFF)
+                continue
+
+            with self.__lock:
+                self.__accepted += 1
+
+            item = (f, time.monotonic())
+            while True:
+                try:
+                    self.__backlog.put(item, timeout=SERVER_ACCEPT_TIMEO)
+                    break
+                except queue.Full:
+                    if not self.__running:
+                        _dealloc_quietly(f)
+                        return
+
+    def __dispatch_loop(self) -> None:
+        while True:
+            self.__slots.acquire()
+            item = self.__backlog.get()
+            if item is None:
+                self.__slots.release()
+                return
+            self.__executor.submit(self.__handle, *item)
+
+    def __handle(self,
+                 flow: Flow,
+                 accepted: float) -> None:
+        latency = time.monotonic() - accepted
+        with self.__lock:
+            self.__active += 1
+            self.__flows.add(flow)
+            self.__latency_sum += latency
+            self.__latency_max = max(self.__latency_max, latency)
+
+        try:
+            self.__handler(flow)
+        except Exception as e:
+            with self.__lock:
+                self.__errors += 1
+            _report_error(e)
+        finally:
+            _dealloc_quietly(flow)
+            with self.__lock:
+                self.__active -= 1
+                self.__flows.discard(flow)
+                self.__handled += 1
+            self.__slots.release()
+
+    def serve_forever(self) -> None:
+        """
+        Start the server and block until stop() is called
+        """
+
+        self.start()
+        for t in self.__threads:
+            t.join()
+
+    def load(self) -> int:
+        """
+        Work in this server: the flows in the backlog, the flows being
+        handled and the SDUs queued on them
+
+        A server with a handler running reports a load, even when its
+        flow is idle.
+
+        :return: The load
+        """
+
+        with self.__lock:
+            flows = list(self.__flows)
+            active = self.__active
+
+        load = self.__backlog.qsize() + active
+        for f in flows:
+            try:
+                load += f.get_rx_queue_len()
+            except FlowException:
+                pass
+
+        return load
+
+    def stats(self) -> dict:
+        """
+        :return: Dict with the number of flows accepted, handled, whose
+                 handler raised, being handled and in the backlog, and
+                 the mean and maximum accept-to-handle latency (s)
+        """
+
+        with self.__lock:
+            started = self.__handled + self.__active
+            return {'accepted': self.__accepted,
+                    'handled': self.__handled,
+                    'errors': self.__errors,
+                    'active': self.__active,
+                    'backlog': self.__backlog.qsize(),
+                    'latency_avg': self.__latency_sum / started
+                    if started else 0.0,
+                    'latency_max': self.__latency_max}
+
+    def stop(self) -> None:
+        """
+        Stop accepting flows, deallocate the flows in the backlog and
+        wait for the running handlers
+        """
+
+        if not self.__running:
+            return
+
+        self.__running = False
+        accept, dispatch = self.__threads
+        accept.join()
+
+        while True:
+            try:
+                item = self.__backlog.get_nowait()
+            except queue.Empty:
+                break
+            _dealloc_quietly(item[0])
+        self.__backlog.put(None)
+        dispatch.join()
+
+        if self.__own_executor:
+            self.__executor.shutdown()
+            self.__executor = None
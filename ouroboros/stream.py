@@ -0,0 +1,366 @@
+#
+# Ouroboros - Copyright (C) 2016 - 2026
+#
+# Python API for Ouroboros - Byte streams over flows
+#
+#    Dimitri Staessens <dimitri@ouroboros.rocks>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# version 2.1 as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., http://www.fsf.org/about/contact/.
+#
+
+import io
+
+from ouroboros.dev import *
+
+# Default size of the receive buffer and of the SDUs that are written
+STREAM_BUFSIZE = 65536
+STREAM_SDU_SIZE = 8192
+
+
+class IncompleteReadError(EOFError):
+    """
+    The flow went down before the requested data was read
+
+    partial:  The bytes read before the flow went down
+    expected: The number of bytes expected (None if unknown)
+    """
+
+    def __init__(self,
+                 partial: bytes,
+                 expected: int = None):
+        super().__init__(f"{len(partial)} bytes read, "
+                         f"{expected} expected")
+        self.partial = partial
+        self.expected = expected
+
+
+class FlowIO(io.RawIOBase):
+    """
+    Raw, unbuffered byte stream over a Flow
+
+    SDU boundaries are not preserved, a flow that is down reads as EOF.
+    """
+
+    def __init__(self,
+                 flow: Flow):
+        self.__flow = flow
+
+    @property
+    def flow(self) -> Flow:
+        return self.__flow
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> Optional[int]:
+        if len(b) == 0:
+            return 0
+
+        try:
+            n = self.__flow.readinto(b)
+            while n == 0:   # skip empty SDUs, they carry no stream data
+                n = self.__flow.readinto(b)
+        except BlockingIOError:
+            return None
+        except FlowDownException:
+            return 0
+
+        return n
+
+    def write(self, b) -> Optional[int]:
+        try:
+            return self.__flow.write(b)
+        except BlockingIOError:
+            return None
+
+
+class FlowStream(io.BufferedIOBase):
+    """
+    Buffered byte stream over a Flow
+
+    Received SDUs are read straight into a single receive buffer, one
+    read per refill, which is compacted when it runs out of space.
+    Writes are collected and sent as SDUs of up to sdu_size bytes.
+
+    Wrap it in an io.TextIOWrapper for text, which decodes incrementally
+    so characters split across SDUs are handled:
+
+        text = io.TextIOWrapper(FlowStream(f), encoding='utf-8')
+    """
+
+    def __init__(self,
+                 flow: Flow,
+                 bufsize: int = STREAM_BUFSIZE,
+                 sdu_size: int = STREAM_SDU_SIZE,
+                 close_flow: bool = False):
+        """
+        :param flow:       The flow to stream over
+        :param bufsize:    Initial size of the receive buffer
+        :param sdu_size:   Maximum size of the SDUs that are written
+        :param close_flow: Deallocate the flow when the stream is closed
+        """
+
+        if bufsize <= 0 or sdu_size <= 0:
+            raise ValueError("Invalid buffer size")
+
+        self.__raw = FlowIO(flow)
+        self.__close_flow = close_flow
+        self.__bufsize = bufsize
+        self.__sdu_size = sdu_size
+        self.__rbuf = bytearray(bufsize)
+        self.__head = 0
+        self.__tail = 0
+        self.__eof = False
+        self.__wbuf = bytearray()
+
+    @property
+    def raw(self) -> FlowIO:
+        return self.__raw
+
+    @property
+    def flow(self) -> Flow:
+        return self.__raw.flow
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            # drop what could not be sent, IOBase.close() flushes again
+            self.__wbuf = bytearray()
+            try:
+                super().close()
+            finally:
+                if self.__close_flow:
+                    self.__raw.flow.dealloc()
+
+    def detach(self) -> FlowIO:
+        self.flush()
+        raw = self.__raw
+        self.__raw = None
+        return raw
+
+    # receive side
+
+    def __buffered(self) -> int:
+        return self.__tail - self.__head
+
+    def __take(self, n: int) -> bytes:
+        data = bytes(self.__rbuf[self.__head:self.__head + n])
+        self.__head += n
+        if self.__head == self.__tail:
+            self.__head = self.__tail = 0
+        return data
+
+    def __fill(self) -> Optional[int]:
+        """
+        Read once from the flow into the receive buffer
+
+        :return: Number of bytes added, 0 on EOF, None on would-block
+        """
+
+        if self.__eof:
+            return 0
+
+        if self.__head > 0 and len(self.__rbuf) - self.__tail < self.__bufsize:
+            n = self.__buffered()
+            self.__rbuf[:n] = self.__rbuf[self.__head:self.__tail]
+            self.__head, self.__tail = 0, n
+
+        if len(self.__rbuf) - self.__tail < self.__bufsize:
+            self.__rbuf.extend(bytes(self.__bufsize))
+
+        n = self.__raw.readinto(memoryview(self.__rbuf)[self.__tail:])
+
+        if n is None:
+            return None
+        if n == 0:
+            self.__eof = True
+        self.__tail += n
+
+        return n
+
+    def __find(self,
+               sep: bytes,
+               start: int) -> int:
+        return self.__rbuf.find(sep, self.__head + start, self.__tail)
+
+    def peek(self,
+             size: int = 0) -> bytes:
+        """
+        Return buffered bytes without consuming them, reads at most once
+
+        :param size: Ignored, as for io.BufferedReader
+        :return:     The buffered bytes
+        """
+
+        if self.__buffered() == 0:
+            self.__fill()
+
+        return bytes(self.__rbuf[self.__head:self.__tail])
+
+    def read1(self,
+              size: int = -1) -> bytes:
+        if self.__buffered() == 0:
+            if self.__fill() is None:
+                return None
+
+        n = self.__buffered()
+        if size >= 0:
+            n = min(n, size)
+
+        return self.__take(n)
+
+    def readinto1(self, b) -> int:
+        data = self.read1(len(b))
+        if data is None:
+            return None
+        b[:len(data)] = data
+        return len(data)
+
+    def read(self,
+             size: int = -1) -> bytes:
+        while size < 0 or self.__buffered() < size:
+            n = self.__fill()
+            if n is None:
+                if self.__buffered() == 0:
+                    return None
+                break
+            if n == 0:
+                break
+
+        n = self.__buffered()
+        if size >= 0:
+            n = min(n, size)
+
+        return self.__take(n)
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        if data is None:
+            return None
+        b[:len(data)] = data
+        return len(data)
+
+    def readexactly(self,
+                    n: int) -> bytes:
+        """
+        Read exactly n bytes
+
+        :param n: Number of bytes to read
+        :return:  The bytes read
+        """
+
+        data = self.read(n)
+        if data is None or len(data) < n:
+            raise IncompleteReadError(data or b"", n)
+
+        return data
+
+    def readuntil(self,
+                  separator: bytes = b"\n") -> bytes:
+        """
+        Read up to and including the separator
+
+        :param separator: The separator to look for
+        :return:          The bytes read, ending in separator
+        """
+
+        if not separator:
+            raise ValueError("Separator should be at least one byte")
+
+        start = 0
+        while True:
+            i = self.__find(separator, start)
+            if i >= 0:
+                return self.__take(i - self.__head + len(separator))
+            start = max(0, self.__buffered() - len(separator) + 1)
+            n = self.__fill()
+            if n is None:
+                raise BlockingIOError()
+            if n == 0:
+                raise IncompleteReadError(self.__take(self.__buffered()))
+
+    def readline(self,
+                 size: int = -1) -> bytes:
+        start = 0
+        while True:
+            i = self.__find(b"\n", start)
+            if i >= 0:
+                n = i - self.__head + 1
+                break
+            n = self.__buffered()
+            if 0 <= size <= n:
+                break
+            start = n
+            r = self.__fill()
+            if not r:
+                break
+
+        if size >= 0:
+            n = min(n, size)
+
+        return self.__take(n)
+
+    # send side
+
+    def __send(self,
+               count: int) -> None:
+        sent = 0
+        view = memoryview(self.__wbuf)
+        try:
+            while sent < count:
+                n = self.__raw.write(view[sent:min(count,
+                                                   sent + self.__sdu_size)])
+                if n is None:
+                    break
+                sent += n
+        finally:
+            # drop what was sent, also if the flow went down meanwhile
+            view.release()
+            try:
+                del self.__wbuf[:sent]
+            except BufferError:
+                # still exported by the traceback of the failed write
+                self.__wbuf = self.__wbuf[sent:]
+
+    def write(self, b) -> int:
+        if self.closed:
+            raise ValueError("write to closed stream")
+
+        with memoryview(b) as view:
+            n = view.nbytes
+            self.__wbuf += view.cast('B')
+
+        if len(self.__wbuf) >= self.__sdu_size:
+            self.__send(len(self.__wbuf) - len(self.__wbuf) % self.__sdu_size)
+
+        return n
+
+    def flush(self) -> None:
+        if self.__wbuf:
+            self.__send(len(self.__wbuf))
+            if self.__wbuf:
+                raise BlockingIOError(errno.EAGAIN,
+                                      "Flow not ready for writing")
@@ -0,0 +1,486 @@
+#
+# Ouroboros - Copyright (C) 2016 - 2026
+#
+# Python API for Ouroboros - Worker process supervision
+#
+#    Dimitri Staessens <dimitri@ouroboros.rocks>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public License
+# version 2.1 as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., http://www.fsf.org/about/contact/.
+#
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+from typing import List
+
+from ouroboros.irm import (
+    BindError,
+    LoadBalancePolicy,
+    NameInfo,
+    bind_process,
+    create_name,
+    list_names,
+    unbind_process,
+)
+
+# Time a worker gets to exit after SIGTERM before it is killed (s)
+SUPERVISOR_STOP_TIMEO = 5.0
+
+# Workers that die sooner than this after starting are restarted
+# only after SUPERVISOR_RESTART_DELAY, to avoid a crash loop (s)
+SUPERVISOR_MIN_UPTIME = 1.0
+SUPERVISOR_RESTART_DELAY = 1.0
+
+# Time a retired worker gets to finish its work before it is stopped (s)
+SUPERVISOR_DRAIN_TIMEO = 30.0
+SUPERVISOR_DRAIN_POLL = 0.1
+
+# Load reported by this process, if it is a supervised worker
+_load_slot = None
+
+
+def _worker_main(target, args, slot) -> None:
+    global _load_slot
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _load_slot = slot
+    target(*args)
+
+
+def report_load(load: float) -> None:
+    """
+    Report the load of this worker to its Supervisor, e.g. the result
+    of FlowServer.load(), a no-op outside a supervised worker
+
+    :param load: The current load
+    """
+
+    if _load_slot is not None:
+        _load_slot.value = load
+
+
+class Supervisor:
+    """
+    Runs worker processes that serve flows for a name
+
+    Each worker is bound to the name with bind_process(), so the IRMd
+    spreads incoming flows over the workers according to the load
+    balancing policy of the name. Workers that die are unbound and
+    replaced.
+
+    The workers are started with the 'spawn' method, a fresh process
+    instead of a fork, as the Ouroboros library registers a process
+    with the IRMd when it is loaded. target must be picklable, e.g. a
+    module level function, and typically accepts flows in a loop:
+
+        def worker():
+            FlowServer(handle).serve_forever()
+    """
+
+    def __init__(self,
+                 name: str,
+                 target,
+                 workers: int = None,
+                 args: tuple = (),
+                 policy: LoadBalancePolicy = None):
+        """
+        :param name:    The name to bind the workers to
+        :param target:  Function run as target(*args) in each worker
+        :param workers: Number of workers (None -> number of CPUs)
+        :param args:    Arguments for target
+        :param policy:  Load balancing policy, to create the name with
+                        if it does not exist yet (None -> IRMd default)
+        """
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError("Need at least one worker")
+
+        self.__name = name
+        self.__target = target
+        self.__args = args
+        self.__policy = policy
+        self.__size = workers
+        self.__ctx = multiprocessing.get_context('spawn')
+        self.__workers = dict()     # sentinel -> (process, start, load)
+        self.__lock = threading.Lock()
+        self.__spawn_lock = threading.Lock()    # counting and spawning
+        self.__running = False
+        self.__restarts = 0
+        self.__wake_r, self.__wake_w = os.pipe()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def pids(self) -> List[int]:
+        with self.__lock:
+            return [p.pid for p, _, _ in self.__workers.values()]
+
+    @property
+    def loads(self) -> List[float]:
+        """
+        Load last reported by each worker, see report_load()
+        """
+
+        with self.__lock:
+            return [slot.value for _, _, slot in self.__workers.values()]
+
+    @property
+    def size(self) -> int:
+        """
+        Number of workers the supervisor maintains
+        """
+
+        return self.__size
+
+    @property
+    def restarts(self) -> int:
+        return self.__restarts
+
+    def __len__(self) -> int:
+        return len(self.__workers)
+
+    def __ensure_name(self) -> None:
+        if self.__policy is None:
+            return
+
+        if not any(n.name == self.__name for n in list_names()):
+            create_name(NameInfo(self.__name, pol_lb=self.__policy))
+
+    def __spawn(self) -> None:
+        slot = self.__ctx.Value('d', 0.0, lock=False)
+        p = self.__ctx.Process(target=_worker_main,
+                               args=(self.__target, self.__args, slot),
+                               name=f"ouroboros-worker-{self.__name}",
+                               daemon=True)
+        p.start()
+        try:
+            bind_process(p.pid, self.__name)
+        except BindError:
+            p.kill()
+            p.join()
+            raise
+
+        with self.__lock:
+            self.__workers[p.sentinel] = (p, time.monotonic(), slot)
+
+    def __unbind(self,
+                 pid: int) -> None:
+        try:
+            unbind_process(pid, self.__name)
+        except BindError:
+            pass    # the IRMd may have dropped the binding already
+
+    def __terminate(self,
+                    p,
+                    timeo: float = SUPERVISOR_STOP_TIMEO) -> None:
+        p.terminate()
+        p.join(timeo)
+        if p.is_alive():
+            p.kill()
+            p.join()
+
+    def __drain(self,
+                p,
+                slot) -> None:
+        # unbind, then give the worker time to finish the work it has
+        self.__unbind(p.pid)
+        deadline = time.monotonic() + SUPERVISOR_DRAIN_TIMEO
+        while p.is_alive() and slot.value > 0 and \
+                time.monotonic() < deadline:
+            time.sleep(SUPERVISOR_DRAIN_POLL)
+        self.__terminate(p)
+
+    def resize(self,
+               workers: int) -> None:
+        """
+        Change the number of workers
+
+        New workers are started at once. Retired workers, the least
+        loaded ones, are unbound at once and stopped once their reported
+        load drops to 0, or after SUPERVISOR_DRAIN_TIMEO.
+
+        :param workers: The new number of workers
+        """
+
+        if workers < 1:
+            raise ValueError("Need at least one worker")
+
+        self.__size = workers
+        if not self.__running:
+            return
+
+        with self.__spawn_lock:
+            while self.__running and len(self.__workers) < self.__size:
+                self.__spawn()
+
+            with self.__lock:
+                excess = len(self.__workers) - self.__size
+                byload = sorted(self.__workers.items(),
+                                key=lambda item: item[1][2].value)
+                retired = [self.__workers.pop(s)
+                           for s, _ in byload[:max(excess, 0)]]
+
+        # supervise() waits on the old workers, make it pick up the new
+        self.__wake()
+
+        for p, _, slot in retired:
+            threading.Thread(target=self.__drain,
+                             args=(p, slot),
+                             name="ouroboros-drain",
+                             daemon=True).start()
+
+    def start(self) -> None:
+        """
+        Start the workers
+        """
+
+        if self.__running:
+            return
+
+        self.__ensure_name()
+        self.__running = True
+        for _ in range(self.__size):
+            self.__spawn()
+
+    def __wake(self) -> None:
+        os.write(self.__wake_w, b"\0")
+
+    def supervise(self,
+                  timeo: float = None) -> int:
+        """
+        Wait for workers to exit and replace them
+
+        :param timeo: Maximum time to wait (None -> until one exits)
+        :return:      Number of workers replaced
+        """
+
+        with self.__lock:
+            sentinels = list(self.__workers)
+
+        ready = multiprocessing.connection.wait(sentinels + [self.__wake_r],
+                                                timeo)
+        if self.__wake_r in ready:
+            os.read(self.__wake_r, 64)
+
+        replaced = 0
+        now = time.monotonic()
+        for s in ready:
+            with self.__lock:
+                entry = self.__workers.pop(s, None)
+            if entry is None:
+                continue
+            p, started, _ = entry
+            p.join()
+            self.__unbind(p.pid)
+            if not self.__running or len(self.__workers) >= self.__size:
+                continue
+            if now - started < SUPERVISOR_MIN_UPTIME:
+                time.sleep(SUPERVISOR_RESTART_DELAY)
+            with self.__spawn_lock:
+                # resize() may have changed the workers meanwhile
+                if not self.__running or \
+                        len(self.__workers) >= self.__size:
+                    continue
+                self.__spawn()
+            self.__restarts += 1
+            replaced += 1
+
+        return replaced
+
+    def serve_forever(self) -> None:
+        """
+        Start the workers and replace those that exit until stop()
+        """
+
+        self.start()
+        while self.__running:
+            self.supervise()
+
+    def stop(self,
+             timeo: float = SUPERVISOR_STOP_TIMEO) -> None:
+        """
+        Unbind and stop all workers
+
+        :param timeo: Time a worker gets to exit before it is killed (s)
+        """
+
+        if not self.__running:
+            return
+
+        self.__running = False
+        self.__wake()
+
+        with self.__lock:
+            workers = [p for p, _, _ in self.__workers.values()]
+            self.__workers.clear()
+
+        # unbind first, so no new flows are sent to the workers
+        for p in workers:
+            self.__unbind(p.pid)
+        for p in workers:
+            self.__terminate(p, timeo)
+
+
+# Default interval between two load samples of an Autoscaler (s)
+AUTOSCALE_INTERVAL = 1.0
+
+# Default mean load per worker above which workers are added, and below
+# which they are retired
+AUTOSCALE_HIGH = 8.0
+AUTOSCALE_LOW = 1.0
+
+# Default number of consecutive samples above or below the thresholds
+# before the number of workers changes
+AUTOSCALE_UP_SAMPLES = 2
+AUTOSCALE_DOWN_SAMPLES = 10
+
+
+class Autoscaler:
+    """
+    Adds and retires workers of a Supervisor based on their load
+
+    The workers report their load with report_load(), for instance
+    FlowServer.load(): the accept backlog, the flows being handled and
+    the SDUs queued on them. The mean load per worker must stay above high
+    for up_samples samples to add a worker, or below low for
+    down_samples samples to retire one, so short bursts do not make the
+    number of workers oscillate.
+    """
+
+    def __init__(self,
+                 supervisor: Supervisor,
+                 min_workers: int = 1,
+                 max_workers: int = None,
+                 high: float = AUTOSCALE_HIGH,
+                 low: float = AUTOSCALE_LOW,
+                 up_samples: int = AUTOSCALE_UP_SAMPLES,
+                 down_samples: int = AUTOSCALE_DOWN_SAMPLES,
+                 interval: float = AUTOSCALE_INTERVAL):
+        """
+        :param supervisor:   The supervisor of the workers
+        :param min_workers:  Minimum number of workers
+        :param max_workers:  Maximum number of workers (None -> CPUs)
+        :param high:         Mean load per worker to add workers at
+        :param low:          Mean load per worker to retire workers at
+        :param up_samples:   Samples above high before adding a worker
+        :param down_samples: Samples below low before retiring a worker
+        :param interval:     Time between two samples (s)
+        """
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError("Invalid worker bounds")
+        if low >= high:
+            raise ValueError("Low threshold should be below high threshold")
+
+        self.__sup = supervisor
+        self.__min = min_workers
+        self.__max = max_workers
+        self.__high = high
+        self.__low = low
+        self.__up_samples = up_samples
+        self.__down_samples = down_samples
+        self.__interval = interval
+        self.__above = 0
+        self.__below = 0
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def sample(self) -> int:
+        """
+        Take one load sample and resize the supervisor if needed
+
+        :return: The change in the number of workers
+        """
+
+        loads = self.__sup.loads
+        load = sum(loads) / len(loads) if loads else 0.0
+        size = self.__sup.size
+
+        if load > self.__high:
+            self.__above += 1
+            self.__below = 0
+        elif load < self.__low:
+            self.__below += 1
+            self.__above = 0
+        else:
+            self.__above = self.__below = 0
+
+        change = 0
+        if size < self.__min:
+            change = self.__min - size
+        elif size > self.__max:
+            change = self.__max - size
+        elif self.__above >= self.__up_samples and size < self.__max:
+            change = 1
+        elif self.__below >= self.__down_samples and size > self.__min:
+            change = -1
+
+        if change != 0:
+            self.__above = self.__below = 0
+            self.__sup.resize(size + change)
+
+        return change
+
+    def __run(self) -> None:
+        while not self.__stop.wait(self.__interval):
+            self.sample()
+
+    def start(self) -> None:
+        """
+        Sample the load every interval seconds in a background thread
+        """
+
+        if self.__thread is not None:
+            return
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="ouroboros-autoscale",
+                                         daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop sampling, the workers keep running
+        """
+
+        if self.__thread is None:
+            return
+
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None